@@ -0,0 +1,338 @@
+"""Benchmark kiểm tra proxy offline: proxy giả trên loopback + nguồn giả qua HTTP cục bộ.
+
+    python benchmarks/bench_checker.py [--proxies 2000] [--seed 1] [--engine streams|protocol]
+
+Proxy giả (HTTP CONNECT / SOCKS4 / SOCKS5, có và không có auth, blackhole, RST, nhỏ giọt, rác)
+chạy ở 1 process riêng để RSS và CPU đo được chỉ là của checker. ProxyFetcher.run() chạy đầy đủ
+trong thư mục tạm; kết quả được so với hành vi đã biết của từng proxy giả (oracle) để tính
+dương tính / âm tính giả, kèm checks/s, CPU cho mỗi check (checks/s trên 1 core), p50/p99 thời gian
+1 check và peak RSS. So sánh 2 engine kiểm tra bằng cách chạy lần lượt với --engine streams / protocol.
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import fetch_proxies as fp  # noqa: E402
+
+AUTH_USER, AUTH_PASS = 'bench', 'secret'
+AUTH_HEADER = b'Proxy-Authorization: Basic YmVuY2g6c2VjcmV0'
+HOLD_TIMEOUT = 10
+DRIP_DELAY = 0.4
+
+
+# ----------------------------------------------------------------
+# PROXY GIẢ
+# ----------------------------------------------------------------
+async def _hold(reader: asyncio.StreamReader):
+    """Giữ connection tới khi client đóng (như 1 tunnel không có dữ liệu)"""
+    try:
+        await asyncio.wait_for(reader.read(), timeout=HOLD_TIMEOUT)
+    except Exception:
+        pass
+
+
+async def http_ok(reader, writer):
+    await reader.readuntil(b'\r\n\r\n')
+    writer.write(b'HTTP/1.1 200 Connection established\r\n\r\n')
+    await _hold(reader)
+
+
+async def http_auth(reader, writer):
+    request = await reader.readuntil(b'\r\n\r\n')
+    if AUTH_HEADER in request:
+        writer.write(b'HTTP/1.1 200 Connection established\r\n\r\n')
+    else:
+        writer.write(b'HTTP/1.1 407 Proxy Authentication Required\r\nProxy-Authenticate: Basic\r\n\r\n')
+    await _hold(reader)
+
+
+async def _socks5_request(reader, writer):
+    ver, _, _, atyp = await reader.readexactly(4)
+    if atyp == 1:
+        await reader.readexactly(4 + 2)
+    elif atyp == 3:
+        await reader.readexactly((await reader.readexactly(1))[0] + 2)
+    else:
+        await reader.readexactly(16 + 2)
+    writer.write(b'\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00')
+    await _hold(reader)
+
+
+async def socks5_ok(reader, writer):
+    ver, count = await reader.readexactly(2)
+    if ver != 5:
+        return
+    methods = await reader.readexactly(count)
+    if 0 not in methods:
+        writer.write(b'\x05\xff')
+        return
+    writer.write(b'\x05\x00')
+    await _socks5_request(reader, writer)
+
+
+async def socks5_auth(reader, writer):
+    ver, count = await reader.readexactly(2)
+    if ver != 5:
+        return
+    if 2 not in await reader.readexactly(count):
+        writer.write(b'\x05\xff')
+        return
+    writer.write(b'\x05\x02')
+    _, ulen = await reader.readexactly(2)
+    user = await reader.readexactly(ulen)
+    password = await reader.readexactly((await reader.readexactly(1))[0])
+    if (user, password) != (AUTH_USER.encode(), AUTH_PASS.encode()):
+        writer.write(b'\x01\x01')
+        return
+    writer.write(b'\x01\x00')
+    await _socks5_request(reader, writer)
+
+
+async def socks4_ok(reader, writer):
+    header = await reader.readexactly(8)
+    if header[0] != 4:
+        return
+    await reader.readuntil(b'\x00')
+    if header[4:7] == b'\x00\x00\x00' and header[7]:
+        await reader.readuntil(b'\x00')     # SOCKS4a: tên miền đích
+    writer.write(b'\x00\x5a\x00\x00\x00\x00\x00\x00')
+    await _hold(reader)
+
+
+async def blackhole(reader, writer):
+    """Nhận connection rồi im lặng"""
+    await _hold(reader)
+
+
+async def rst(reader, writer):
+    """Đóng bằng RST ngay khi nhận request"""
+    await reader.read(1)
+    writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+    writer.transport.abort()
+
+
+async def slow_drip(reader, writer):
+    """Trả lời đúng nhưng từng byte một (kiểu slowloris)"""
+    await reader.read(1024)
+    for byte in b'HTTP/1.1 200 Connection established\r\n\r\n':
+        writer.write(bytes([byte]))
+        await asyncio.sleep(DRIP_DELAY)
+
+
+async def garbage(reader, writer):
+    """Dịch vụ không phải proxy"""
+    writer.write(b'SSH-2.0-OpenSSH_9.6\r\n')
+    await _hold(reader)
+
+
+# (tên, handler, protocol mong đợi, file nguồn, dòng trong nguồn, tỉ trọng)
+BEHAVIOURS = [
+    ('http', http_ok, 'http', 'http.txt', '{addr}', 12),
+    ('http_unlabeled', http_ok, 'http', 'mixed.txt', '{addr}', 4),
+    ('http_auth', http_auth, 'http', 'mixed.txt', f'http://{AUTH_USER}:{AUTH_PASS}@{{addr}}', 2),
+    ('http_auth_wrong', http_auth, None, 'mixed.txt', f'http://{AUTH_USER}:wrong@{{addr}}', 1),
+    ('socks5', socks5_ok, 'socks5', 'socks5.txt', '{addr}', 8),
+    ('socks5_unlabeled', socks5_ok, 'socks5', 'mixed.txt', '{addr}', 3),
+    ('socks5_auth', socks5_auth, 'socks5', 'mixed.txt', f'socks5://{AUTH_USER}:{AUTH_PASS}@{{addr}}', 2),
+    ('socks5_auth_wrong', socks5_auth, None, 'mixed.txt', f'socks5://{AUTH_USER}:wrong@{{addr}}', 1),
+    ('socks4', socks4_ok, 'socks4', 'socks4.txt', '{addr}', 6),
+    ('socks4_unlabeled', socks4_ok, 'socks4', 'mixed.txt', '{addr}', 2),
+    ('blackhole', blackhole, None, 'http.txt', '{addr}', 15),
+    ('rst', rst, None, 'socks5.txt', '{addr}', 10),
+    ('slow_drip', slow_drip, None, 'http.txt', '{addr}', 5),
+    ('garbage', garbage, None, 'mixed.txt', '{addr}', 9),
+    ('refused', None, None, 'socks4.txt', '{addr}', 20),
+]
+
+
+def _guard(handler):
+    async def wrapped(reader, writer):
+        try:
+            await handler(reader, writer)
+        except Exception:
+            pass
+        finally:
+            writer.close()
+    return wrapped
+
+
+async def _serve(conn, count: int, seed: int):
+    from aiohttp import web
+
+    rnd = random.Random(seed)
+    picks = rnd.choices(BEHAVIOURS, weights=[b[5] for b in BEHAVIOURS], k=count)
+    servers = []
+    lists = {}
+    expected = {}
+    refused = []
+    for behaviour in picks:
+        name, handler, proto, source, line, _ = behaviour
+        if handler is None:
+            refused.append(behaviour)
+            continue
+        server = await asyncio.start_server(_guard(handler), '127.0.0.1', 0, backlog=1024)
+        servers.append(server)
+        addr = f"127.0.0.1:{server.sockets[0].getsockname()[1]}"
+        lists.setdefault(source, []).append(line.format(addr=addr))
+        expected[addr] = (name, proto)
+    # Cổng đóng: xin cổng (giữ tới khi xin đủ để không trùng nhau) rồi thả ra, không listen
+    held = []
+    for name, _, proto, source, line, _ in refused:
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        held.append(sock)
+        addr = f"127.0.0.1:{sock.getsockname()[1]}"
+        lists.setdefault(source, []).append(line.format(addr=addr))
+        expected[addr] = (name, proto)
+    for sock in held:
+        sock.close()
+
+    app = web.Application()
+    for source, lines in lists.items():
+        body = '\n'.join(lines)
+        app.router.add_get(f'/{source}', lambda request, body=body: web.Response(text=body))
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    source_port = site._server.sockets[0].getsockname()[1]
+
+    conn.send((source_port, sorted(lists), expected))
+    await asyncio.get_running_loop().run_in_executor(None, conn.recv)
+    await runner.cleanup()
+    for server in servers:
+        server.close()
+
+
+def serve(conn, count: int, seed: int):
+    _raise_nofile()
+    asyncio.run(_serve(conn, count, seed))
+
+
+def _raise_nofile():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+# ----------------------------------------------------------------
+# CHECKER
+# ----------------------------------------------------------------
+class TimedFetcher(fp.ProxyFetcher):
+    """Đo thời gian từng check và thời gian phase kiểm tra lần 1"""
+
+    def __init__(self):
+        super().__init__()
+        self.check_times = []
+        self.verify_elapsed = 0.0
+        self.verify_cpu = 0.0
+
+    async def verify_task(self, ikey, mask):
+        checked = self.checked_count
+        started = time.perf_counter()
+        await super().verify_task(ikey, mask)
+        if self.checked_count != checked:
+            self.check_times.append(time.perf_counter() - started)
+
+    async def run_verify_workers(self, count):
+        started, cpu_started = time.perf_counter(), time.process_time()
+        await super().run_verify_workers(count)
+        self.verify_elapsed = time.perf_counter() - started
+        self.verify_cpu = time.process_time() - cpu_started
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--proxies', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--engine', choices=('streams', 'protocol'), default=fp.CHECK_ENGINE)
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('spawn')
+    parent_conn, child_conn = ctx.Pipe()
+    server = ctx.Process(target=serve, args=(child_conn, args.proxies, args.seed), daemon=True)
+    server.start()
+    source_port, sources, expected = parent_conn.recv()
+
+    workdir = tempfile.mkdtemp(prefix='bench_checker_')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        with open(fp.SOURCES_FILE, 'w', encoding='utf-8') as f:
+            f.writelines(f"http://127.0.0.1:{source_port}/{source}\n" for source in sources)
+        fp.ALLOW_PRIVATE_IPS = True
+        fp.CHECK_ENGINE = args.engine
+        fp.TEST_TARGETS = ['localhost:443']
+        fp.logger.setLevel(logging.WARNING)
+        _raise_nofile()
+
+        fetcher = TimedFetcher()
+        started = time.perf_counter()
+        asyncio.run(fetcher.run())
+        total = time.perf_counter() - started
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+        parent_conn.send('stop')
+        server.join(timeout=5)
+
+    live = {f"{p['ip']}:{p['port']}": p['type'] for p in fetcher.live_proxies.values()}
+    by_behaviour = {}
+    false_pos = false_neg = wrong_type = 0
+    expected_live = sum(1 for _, proto in expected.values() if proto)
+    for addr, (name, proto) in expected.items():
+        got = live.get(addr)
+        stats = by_behaviour.setdefault(name, [0, 0])
+        stats[0] += 1
+        stats[1] += bool(got)
+        if proto and not got:
+            false_neg += 1
+        elif not proto and got:
+            false_pos += 1
+        elif proto and got != proto:
+            wrong_type += 1
+    expected_dead = len(expected) - expected_live
+
+    rate = fetcher.checked_count / fetcher.verify_elapsed if fetcher.verify_elapsed else 0.0
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / 1024 / (1024 if sys.platform == 'darwin' else 1)
+    print(f"proxies giả     : {len(expected)} ({expected_live} live, {expected_dead} chết)")
+    print(f"tổng thời gian  : {total:.2f}s (kiểm tra lần 1: {fetcher.verify_elapsed:.2f}s)")
+    print(f"checks          : {fetcher.checked_count} → {rate:.0f} checks/s (engine {args.engine})")
+    if fetcher.checked_count and fetcher.verify_cpu:
+        print(f"CPU kiểm tra    : {fetcher.verify_cpu:.2f}s → {fetcher.verify_cpu / fetcher.checked_count * 1e6:.0f} µs/check, "
+              f"{fetcher.checked_count / fetcher.verify_cpu:.0f} checks/s trên 1 core")
+    print(f"latency 1 check : p50 {percentile(fetcher.check_times, 0.5) * 1000:.1f} ms | "
+          f"p99 {percentile(fetcher.check_times, 0.99) * 1000:.1f} ms")
+    print(f"peak RSS        : {peak_rss_mb:.1f} MB")
+    print(f"dương tính giả  : {false_pos} ({false_pos / max(1, expected_dead):.2%})")
+    print(f"âm tính giả     : {false_neg} ({false_neg / max(1, expected_live):.2%})")
+    print(f"sai protocol    : {wrong_type}")
+    print(f"lý do thất bại  : {', '.join(f'{r}={n}' for r, n in sorted(fetcher.metrics.failures.items()))}")
+    print()
+    for name, _, proto, _, _, _ in BEHAVIOURS:
+        if name in by_behaviour:
+            count, got = by_behaviour[name]
+            print(f"  {name:<18} mong đợi {proto or 'chết':<7} {got:>5}/{count:<5} live")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""So sánh CPU cho mỗi check giữa 2 engine kiểm tra: 'streams' (StreamReader/Writer) và 'protocol'
+(asyncio.Protocol + 1 deadline + SO_LINGER 0).
+
+    python benchmarks/bench_engine.py [--checks 20000] [--concurrency 200] [--rounds 2]
+
+Proxy giả (dùng lại từ bench_checker) chạy ở 1 process riêng; process chính chỉ gọi _check_single
+lặp lại trên cùng 1 proxy cho từng loại, nên CPU đo được là chi phí của riêng 1 check (không lẫn tải
+nguồn / parse như bench_checker).
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import fetch_proxies as fp  # noqa: E402
+from bench_checker import _guard, _raise_nofile, http_ok, rst, socks4_ok, socks5_ok  # noqa: E402
+
+CASES = [
+    # (tên, handler, protocol kiểm tra, live?)
+    ('http', http_ok, 'http', True),
+    ('socks5', socks5_ok, 'socks5', True),
+    ('socks4', socks4_ok, 'socks4', True),
+    ('rst', rst, 'http', False),
+    ('refused', None, 'http', False),
+]
+
+
+async def _serve(conn):
+    servers = []
+    ports = {}
+    for name, handler, _, _ in CASES:
+        if handler is None:
+            sock = socket.socket()
+            sock.bind(('127.0.0.1', 0))
+            ports[name] = sock.getsockname()[1]
+            sock.close()
+            continue
+        server = await asyncio.start_server(_guard(handler), '127.0.0.1', 0, backlog=4096)
+        servers.append(server)
+        ports[name] = server.sockets[0].getsockname()[1]
+    conn.send(ports)
+    await asyncio.get_running_loop().run_in_executor(None, conn.recv)
+    for server in servers:
+        server.close()
+
+
+def serve(conn):
+    _raise_nofile()
+    asyncio.run(_serve(conn))
+
+
+async def measure(engine: str, port: int, proto: str, checks: int, concurrency: int):
+    fetcher = fp.ProxyFetcher()
+    fetcher.engine = engine
+    await fetcher.targets.resolve()
+    gate = asyncio.Semaphore(concurrency)
+    live = 0
+
+    async def one():
+        nonlocal live
+        async with gate:
+            result = await fetcher._check_single('127.0.0.1', str(port), proto, None, None)
+            live += result.proto is not None
+
+    cpu_started, started = time.process_time(), time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(checks)])
+    return time.process_time() - cpu_started, time.perf_counter() - started, live
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--checks', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--rounds', type=int, default=2, help="số lượt đo xen kẽ cho mỗi engine (lấy lượt tốt nhất)")
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('spawn')
+    parent_conn, child_conn = ctx.Pipe()
+    server = ctx.Process(target=serve, args=(child_conn,), daemon=True)
+    server.start()
+    ports = parent_conn.recv()
+
+    fp.TEST_TARGETS = ['localhost:443']
+    fp.logger.setLevel(logging.WARNING)
+    _raise_nofile()
+    try:
+        print(f"{'loại':<8} {'engine':<9} {'µs/check':>9} {'checks/s/core':>14} {'wall':>7}  live")
+        for name, _, proto, expect_live in CASES:
+            best = {}
+            for _ in range(args.rounds):
+                for engine in ('streams', 'protocol'):
+                    cpu, wall, live = asyncio.run(measure(engine, ports[name], proto, args.checks, args.concurrency))
+                    if engine not in best or cpu < best[engine][0]:
+                        best[engine] = (cpu, wall, live)
+            for engine, (cpu, wall, live) in best.items():
+                ok = live == (args.checks if expect_live else 0)
+                print(f"{name:<8} {engine:<9} {cpu / args.checks * 1e6:>9.0f} {args.checks / cpu:>14.0f} "
+                      f"{wall:>6.2f}s  {live}{'' if ok else ' (!)'}")
+            print(f"{'':<8} → protocol dùng {best['protocol'][0] / best['streams'][0]:.0%} CPU của streams")
+    finally:
+        parent_conn.send('stop')
+        server.join(timeout=5)
+
+
+if __name__ == '__main__':
+    main()
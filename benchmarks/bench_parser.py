@@ -0,0 +1,105 @@
+"""So sánh tốc độ parse nguồn: PROXY_RE trên cả payload (cách cũ) với SourceParser theo chunk bytes.
+
+    python benchmarks/bench_parser.py [--lines 300000] [--repeat 3]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fetch_proxies import PROXY_RE, SOURCE_CHUNK_SIZE, SourceParser  # noqa: E402
+
+
+def make_payload(lines: int, seed: int = 1) -> bytes:
+    """~95% dòng 'ip:port' thuần, còn lại có scheme / credentials / rác"""
+    rnd = random.Random(seed)
+    out = []
+    for _ in range(lines):
+        ip = '.'.join(str(rnd.randint(1, 254)) for _ in range(4))
+        port = rnd.choice((80, 8080, 3128, 1080, rnd.randint(1024, 65535)))
+        kind = rnd.random()
+        if kind < 0.95:
+            out.append(f"{ip}:{port}")
+        elif kind < 0.98:
+            out.append(f"{rnd.choice(('http', 'socks4', 'socks5'))}://{ip}:{port}")
+        elif kind < 0.99:
+            out.append(f"socks5://user{rnd.randint(1, 99)}:pass@{ip}:{port}")
+        else:
+            out.append(f"{ip}:{port} US elite 2026-10-01")
+    return '\n'.join(out).encode()
+
+
+def legacy_parse(content: str, url: str) -> dict:
+    """Bản sao của parse_proxy_list trước khi có SourceParser (giữ nguyên chi phí dựng dict)"""
+    raw_proxies = {}
+    url_lower = url.lower()
+    for match in PROXY_RE.finditer(content):
+        ip, port = match.group('ip'), match.group('port')
+        if not ip or not port:
+            continue
+        if match.group('protocol'):
+            protocols = [match.group('protocol').lower()]
+        else:
+            if 'socks5' in url_lower:
+                protocols = ['socks5']
+            elif 'socks4' in url_lower:
+                protocols = ['socks4']
+            elif 'http' in url_lower:
+                protocols = ['http']
+            else:
+                protocols = ['http', 'socks5', 'socks4']
+        key = f"{ip}:{port}"
+        if key not in raw_proxies:
+            raw_proxies[key] = {
+                'ip': ip, 'port': port, 'protocols': protocols,
+                'username': match.group('username'), 'password': match.group('password'),
+                'country': 'Unknown', 'countryCode': '??', 'isp': 'Unknown', 'user_type': 'Unknown'
+            }
+        else:
+            for proto in protocols:
+                if proto not in raw_proxies[key]['protocols']:
+                    raw_proxies[key]['protocols'].append(proto)
+    return raw_proxies
+
+
+def streaming_parse(payload: bytes) -> list:
+    parser = SourceParser(['http'])
+    for i in range(0, len(payload), SOURCE_CHUNK_SIZE):
+        parser.feed(payload[i:i + SOURCE_CHUNK_SIZE])
+    parser.close()
+    return parser.protocols
+
+
+def best_of(repeat: int, fn, *args) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', type=int, default=300000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    payload = make_payload(args.lines)
+    mb = len(payload) / 1024 / 1024
+    url = 'https://example.com/http.txt'
+
+    # Cách cũ tính cả bước response.text() decode payload
+    legacy = best_of(args.repeat, lambda: legacy_parse(payload.decode('utf-8'), url))
+    streaming = best_of(args.repeat, streaming_parse, payload)
+
+    print(f"payload: {args.lines} dòng, {mb:.1f} MB")
+    print(f"legacy   : {legacy * 1000:8.1f} ms  ({mb / legacy:6.1f} MB/s)")
+    print(f"streaming: {streaming * 1000:8.1f} ms  ({mb / streaming:6.1f} MB/s)  x{legacy / streaming:.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -7,10 +7,27 @@ import json
 import base64
 import time
 import socket
+import struct
+import sqlite3
+import hashlib
+import gzip
+import bisect
+import random
+import heapq
+import signal
+import contextlib
+import ssl
+import errno
+import argparse
+import multiprocessing
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from urllib.parse import urlparse
 from datetime import datetime
 from typing import Dict, List, Optional, Any, Set, Tuple
 import aiohttp
+from aiohttp import web
 import geoip2.database
 
 # ============================================================
@@ -22,6 +39,16 @@ try:
 except ImportError:
     pass
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 try:
     import resource
     _soft, _hard = resource.getrlimit(resource.RLIMIT_NOFILE)
@@ -32,39 +59,1495 @@ except Exception:
 # ============================================================
 # CONFIG
 # ============================================================
-MAX_CONCURRENT = 8000
+MAX_CONCURRENT = 8000               # trần số check đồng thời (= số worker); giới hạn thực do AIMD điều chỉnh
+CONCURRENCY_START = 1000
+CONCURRENCY_MIN = 100
+CONCURRENCY_STEP = 250              # tăng cộng mỗi chu kỳ khi mọi thứ ổn
+CONCURRENCY_BACKOFF = 0.7           # giảm nhân khi có dấu hiệu quá tải
+ADAPT_INTERVAL = 1.0
+ADAPT_MIN_SAMPLES = 50              # số connect thành công tối thiểu trong 1 chu kỳ để đánh giá nghẽn
+CONNECT_RTT_FACTOR = 1.5            # trung vị thời gian connect (của endpoint có trả lời) vượt mức nền × 1.5...
+CONNECT_RTT_SLACK = 0.05            # ... + 50ms thì coi là nghẽn
+CONNECT_RTT_WINDOW = 30             # mức nền = trung vị nhỏ nhất trong 30 chu kỳ gần nhất
+LOOP_LAG_LIMIT = 0.2
+VERIFY_PROCESSES = 1                # >1: chia raw_proxies cho nhiều process, mỗi process 1 event loop
 CHECK_TIMEOUT = 1.5
 CONNECT_TIMEOUT = 1.0
+CHECK_ENGINE = 'streams'            # --engine: 'streams' (StreamReader/Writer) hoặc 'protocol' (asyncio.Protocol, ít overhead hơn)
 SOURCE_TIMEOUT = 8
-TEST_URL = 'cp.cloudflare.com'
+SOURCE_CHUNK_SIZE = 64 * 1024
+# Các đích kiểm tra, check được xoay vòng qua từng đích (1 đích bị rate-limit/sập không làm hỏng cả lượt chạy)
+TEST_TARGETS = ['cp.cloudflare.com:443', 'www.gstatic.com:443', 'detectportal.firefox.com:443']
+TARGET_DNS_TTL = 600
+TARGET_MIN_SAMPLES = 300            # số lượt handshake tối thiểu trước khi đánh giá 1 đích
+TARGET_DISABLE_RATIO = 0.25         # tắt đích có tỉ lệ thành công < 25% đích tốt nhất...
+TARGET_DISABLE_COOLDOWN = 600       # ... trong 10 phút, sau đó bật lại và đếm lại từ đầu (đích chỉ bị chặn tạm thời)
+MEASURE_TRANSFER = False            # đo tốc độ tải 1 payload nhỏ qua proxy ở lượt xác nhận
+TRANSFER_PATH = '/'
+TRANSFER_MAX_BYTES = 64 * 1024
+TRANSFER_TIMEOUT = 3.0
+LATENCY_REF_MS = 250                # score = 100 * ref / (ref + latency)
+FAST_LATENCY_MS = 500               # ngưỡng cho api/fast.json
+LATENCY_TIERS_MS = (100, 250, 500, 1000, 2500, 5000, 10000)   # file export chỉ ghi bậc latency (làm tròn lên, score tính theo bậc)...
+SPEED_TIERS_KBPS = (0, 50, 100, 250, 500, 1000, 2500, 5000)    # ... bậc tốc độ tải (làm tròn xuống)...
+EXPORT_FIELDS = ('ip', 'port', 'protocols', 'username', 'password', 'type',   # ... và các trường ổn định giữa
+                 'country', 'countryCode', 'isp', 'asn', 'user_type')         # các lần chạy, để file ít bị ghi lại
+ALLOW_PRIVATE_IPS = False           # chỉ bật khi kiểm tra proxy giả trên loopback (benchmarks/)
 OUTPUT_FILE = 'proxies.txt'
 SOURCES_FILE = 'sources.txt'
 DB_COUNTRY = 'geoip/GeoLite2-Country.mmdb'
 DB_ASN = 'geoip/GeoLite2-ASN.mmdb'
+HEALTH_DB = 'cache/health.db'
+HEALTH_GRACE_FAILS = 2              # số lần fail liên tiếp trước khi bắt đầu backoff
+HEALTH_BACKOFF_BASE = 3 * 3600      # = 1 chu kỳ cron
+HEALTH_BACKOFF_MAX = 7 * 86400
+HEALTH_PRUNE_AFTER = 30 * 86400     # xoá bản ghi không còn xuất hiện trong nguồn nào
+HEALTH_SEEN_RESOLUTION = 3600       # last_seen chỉ cập nhật (và ghi lại) khi cũ hơn 1 giờ, nguồn tải lại không ghi cả store
+SOURCE_CACHE = 'cache/sources.json'
+SOURCE_STATS = 'cache/source_stats.json'
+SOURCE_STATS_ALPHA = 0.3            # trọng số lần chạy mới trong trung bình trượt (EWMA) của thống kê nguồn
+SOURCE_MIN_RUNS = 3                 # số lần chạy có thống kê tối thiểu trước khi áp dụng chính sách cho nguồn
+SOURCE_DEMOTE_YIELD = 0.001         # live/ứng viên đã kiểm tra dưới 0.1% → ứng viên của nguồn được kiểm tra sau cùng
+SOURCE_THROTTLE_LIVE_PER_MB = 2     # dưới 2 proxy live / MB tải...
+SOURCE_THROTTLE_UNIQUE = 0.05       # ... hoặc dưới 5% ứng viên là riêng của nguồn (mirror) → tải thưa:
+SOURCE_THROTTLE_SKIP = 3            # ... bỏ qua 3 lần chạy rồi mới tải lại (giữa chừng dùng danh sách đã cache)
+SOURCE_DIE_DRY_RUNS = 10            # 10 lần chạy liên tiếp không đóng góp proxy live nào → # [DIE] (vẫn tải thưa)
+SKIP_UNCHANGED_DEAD = True          # không kiểm tra lại proxy chết lần trước nếu chỉ đến từ nguồn không đổi...
+UNCHANGED_RECHECK_AFTER = 86400     # ... trong vòng 1 ngày kể từ lần kiểm tra cuối
+RUN_BUDGET = None                   # --budget: giới hạn tổng thời gian chạy (giây), hết giờ thì export phần đã kiểm tra
+BUDGET_VERIFY_SHARE = 0.75          # tải nguồn + kiểm tra lần 1 dừng ở 75% ngân sách...
+BUDGET_CONFIRM_SHARE = 0.9          # ... xác nhận dừng ở 90%, phần còn lại cho định vị + export
+PRIOR_LIVE_WINDOW = 3 * 86400       # mạng /24 (/16) có proxy live trong 3 ngày gần đây được kiểm tra trước
+COMMON_PROXY_PORTS = frozenset({80, 81, 443, 1080, 1081, 1088, 3128, 3129, 4145, 5678, 8000, 8001,
+                                8080, 8081, 8088, 8118, 8443, 8888, 9050, 9090, 9999, 10808})
+EXPORT_HASHES = 'api/.hashes.json'  # hash dữ liệu đã xuất: file không đổi thì không ghi lại
+EXPORT_COMPRESS = True              # ghi kèm bản nén sẵn .gz (và .br nếu có module brotli) cho file trong api/
+WEB_DIR = 'api/web'                 # dữ liệu cho index.html: manifest nhỏ + các shard tải dần
+WEB_SHARD_SIZE = 200                # số proxy mỗi shard (trang đầu chỉ cần manifest + 1 shard)
+REPORT_FILE = 'api/report.json'     # số liệu của lần chạy (thời gian phase, lý do lỗi, latency...)
+PROMETHEUS_FILE = None              # vd. 'cache/metrics.prom' cho textfile collector của node_exporter
+METRICS_INTERVAL = 1.0              # chu kỳ lấy mẫu độ trễ event loop và số FD đang mở
+LATENCY_SAMPLES = 5                 # số mẫu latency gần nhất giữ cho mỗi proxy
+
+# --daemon: chạy liên tục, giữ pool live trong bộ nhớ và kiểm tra lại theo lịch
+DAEMON_CHECK_RATE = 200             # số check được bắt đầu mỗi giây (proxy mới + kiểm tra lại)
+DAEMON_WORKERS = 1000               # worker xử lý hàng đợi proxy mới
+DAEMON_SOURCE_INTERVAL = 15 * 60    # chu kỳ tải lại 1 nguồn; nguồn không đổi thì giãn gấp đôi...
+DAEMON_SOURCE_INTERVAL_MAX = 2 * 3600   # ... tới tối đa 2 giờ
+DAEMON_EVICT_AFTER = 3 * DAEMON_SOURCE_INTERVAL_MAX   # proxy không nguồn nào liệt kê trong 6 giờ bị bỏ khỏi bộ nhớ
+DAEMON_RECHECK_MIN = 60             # proxy vừa live được kiểm tra lại sau 1 phút, mỗi lần ổn định giãn gấp đôi...
+DAEMON_RECHECK_MAX = 15 * 60        # ... tới tối đa 15 phút
+DAEMON_DEAD_RETRY = HEALTH_BACKOFF_BASE     # proxy chết chỉ được thử lại khi nguồn còn liệt kê và đã qua ít nhất chừng này
+DAEMON_EXPORT_INTERVAL = 5 * 60     # chu kỳ xuất snapshot ra các định dạng export
+DAEMON_SOURCE_ACCOUNT_INTERVAL = HEALTH_BACKOFF_BASE   # thống kê nguồn: daemon tính 1 "lần chạy" mỗi 3 giờ
+                                                        # (= 1 chu kỳ cron), không phải mỗi snapshot
+API_HOST = '127.0.0.1'              # --api: HTTP API truy vấn pool live trong bộ nhớ (chỉ với --daemon)
+API_PORT = None
+API_INDEX_TTL = 10                  # chỉ mục được dựng lại tối đa 1 lần mỗi 10s
+API_DEFAULT_LIMIT = 100
+API_MAX_LIMIT = 1000
+GATEWAY_HOST = '127.0.0.1'          # --gateway: forward proxy (HTTP CONNECT + SOCKS5) xoay vòng qua pool live
+GATEWAY_PORT = None
+GATEWAY_MAX_PER_UPSTREAM = 8        # số connection đồng thời tối đa qua 1 proxy
+GATEWAY_RETRIES = 3                 # số lần thử proxy khác khi connect/handshake thất bại
+GATEWAY_EJECT_SECONDS = 120         # proxy lỗi bị loại khỏi gateway cho tới khi recheck thành công
+GATEWAY_POOL_TTL = 5                # bảng trọng số chọn proxy dựng lại mỗi 5s
+GATEWAY_PICK_TRIES = 8              # số lần bốc ngẫu nhiên theo trọng số trước khi quét toàn bộ
+GATEWAY_CLIENT_TIMEOUT = 10         # thời gian tối đa để client gửi xong yêu cầu CONNECT
+GATEWAY_IDLE_TIMEOUT = 300          # 1 chiều đã đóng thì chiều còn lại có tối đa 300s để kết thúc
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s', datefmt='%H:%M:%S', handlers=[logging.StreamHandler(sys.stdout)])
 logger = logging.getLogger("ProxyMaster")
 
+# Chỉ dùng để đo tốc độ tải, không xác thực chứng chỉ
+TRANSFER_SSL_CONTEXT = ssl.create_default_context()
+TRANSFER_SSL_CONTEXT.check_hostname = False
+TRANSFER_SSL_CONTEXT.verify_mode = ssl.CERT_NONE
+
 PROXY_RE = re.compile(
     r'(?:(?P<protocol>http|https|socks4|socks5)://)?'
     r'(?:(?P<username>[^:@\s]+):(?P<password>[^:@\s]+)@)?'
     r'(?P<ip>(?:[0-9]{1,3}\.){3}[0-9]{1,3}):(?P<port>[0-9]{1,5})',
     re.IGNORECASE
 )
+_OCTET = r'(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])'
+# Mỗi dòng khớp đúng 1 nhánh: (key, ip, port) cho dòng "ip:port" thuần, hoặc (other) cho dòng còn lại
+PLAIN_LINE_RE = re.compile(
+    rf'^[ \t]*((?P<ip>{_OCTET}(?:\.{_OCTET}){{3}}):(?P<port>[0-9]{{1,5}}))[ \t\r]*$|^(.+)$',
+    re.MULTILINE
+)
+PLAIN_IP_RE = re.compile(rf'{_OCTET}(?:\.{_OCTET}){{3}}$')
 
 
-class ProxyFetcher:
+# Key gọn: "a.b.c.d:port" → int (ip << 16 | port), protocol → 1 bit.
+# 1 cặp (proxy, protocol) cần kiểm tra = check id (key << 4 | bit).
+PROTO_BITS = {'http': 1, 'https': 2, 'socks4': 4, 'socks5': 8}
+BIT_PROTOS = {bit: proto for proto, bit in PROTO_BITS.items()}
+MASK_BITS = tuple(tuple(bit for bit in (1, 2, 4, 8) if mask & bit) for mask in range(16))
+_MASK_CACHE: Dict[Tuple[str, ...], int] = {}
+
+
+def pack_key(ip: str, port) -> int:
+    a, b, c, d = ip.split('.')
+    return (int(a) << 40) | (int(b) << 32) | (int(c) << 24) | (int(d) << 16) | int(port)
+
+
+def unpack_key(ikey: int) -> Tuple[str, int]:
+    ip = ikey >> 16
+    return f"{ip >> 24}.{(ip >> 16) & 255}.{(ip >> 8) & 255}.{ip & 255}", ikey & 0xFFFF
+
+
+def proto_mask(protocols: Tuple[str, ...]) -> int:
+    mask = _MASK_CACHE.get(protocols)
+    if mask is None:
+        mask = _MASK_CACHE[protocols] = sum({PROTO_BITS[p] for p in protocols})
+    return mask
+
+
+def mask_protos(mask: int) -> List[str]:
+    return [BIT_PROTOS[bit] for bit in MASK_BITS[mask]]
+
+
+class CandidateStore:
+    """Tập proxy thô dạng gọn: key int → bitmask protocol.
+    Credentials nằm ở bảng riêng (chỉ số ít proxy có); dict đầy đủ chỉ tạo cho proxy live."""
+    __slots__ = ('masks', 'credentials')
+
+    def __init__(self):
+        self.masks: Dict[int, int] = {}
+        self.credentials: Dict[int, Tuple[str, str]] = {}
+
+    def __len__(self) -> int:
+        return len(self.masks)
+
+    def __contains__(self, ikey: int) -> bool:
+        return ikey in self.masks
+
+    def add(self, ikey: int, mask: int, username: Optional[str], password: Optional[str]) -> int:
+        """Thêm protocol cho proxy, trả về các bit protocol chưa có trước đó"""
+        current = self.masks.get(ikey, 0)
+        new = mask & ~current
+        if new:
+            self.masks[ikey] = current | new
+        if username and password and ikey not in self.credentials:
+            self.credentials[ikey] = (username, password)
+        return new
+
+    def remove(self, ikey: int):
+        self.masks.pop(ikey, None)
+        self.credentials.pop(ikey, None)
+
+    def auth(self, ikey: int) -> Tuple[Optional[str], Optional[str]]:
+        return self.credentials.get(ikey, (None, None))
+
+    def materialize(self, ikey: int) -> Dict[str, Any]:
+        ip, port = unpack_key(ikey)
+        username, password = self.auth(ikey)
+        return {
+            'ip': ip, 'port': str(port), 'protocols': mask_protos(self.masks.get(ikey, 0)),
+            'username': username, 'password': password,
+            'country': 'Unknown', 'countryCode': '??', 'isp': 'Unknown', 'asn': None, 'user_type': 'Unknown'
+        }
+
+
+class HealthStore:
+    """Lưu lịch sử kiểm tra theo (ip:port, protocol) giữa các lần chạy (SQLite).
+
+    Trong bộ nhớ mỗi cặp (key, protocol) là 1 dòng trong các mảng song song; chỉ mục theo key int
+    (dùng chung object key với CandidateStore) trỏ tới dòng đầu, các protocol khác của cùng key nối
+    tiếp qua mảng next — không tạo object Python cho từng dòng.
+    """
+    COLUMNS = ('bits', 'first_seen', 'last_seen', 'last_live', 'last_checked', 'fails', 'first_source', 'dirty')
+
+    def __init__(self, path: str = HEALTH_DB):
+        self.path = path
+        self.index: Dict[int, int] = {}
+        self.bits = bytearray()
+        self.next = array('i')
+        self.first_seen = array('d')
+        self.last_seen = array('d')
+        self.last_live = array('d')
+        self.last_checked = array('d')
+        self.fails = array('H')
+        self.first_source = array('H')
+        self.dirty = bytearray()
+        self.garbage = 0                    # số dòng của key đã forget(), thu hồi khi nén mảng
+        # Nguồn lưu theo id (0 = không rõ)
+        self.sources: List[Optional[str]] = [None]
+        self.source_ids: Dict[str, int] = {}
+        # Chế độ shard: process con chỉ ghi nhật ký kết quả, process chính replay vào store
+        self.journal: Optional[List[Tuple[int, bool, float]]] = None
+
+    def __len__(self) -> int:
+        return len(self.bits) - self.garbage
+
+    def load(self):
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with sqlite3.connect(self.path) as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS health ("
+                    "key TEXT NOT NULL, proto TEXT NOT NULL, first_seen REAL, first_source TEXT, "
+                    "last_seen REAL, last_live REAL, last_checked REAL, fails INTEGER, "
+                    "PRIMARY KEY (key, proto))"
+                )
+                stored = conn.execute(
+                    "SELECT key, proto, first_seen, first_source, last_seen, last_live, last_checked, fails FROM health"
+                ).fetchall()
+        except sqlite3.Error as e:
+            logger.warning(f"Không đọc được health store '{self.path}': {e}")
+            stored = []
+        for key, proto, first_seen, source, last_seen, last_live, last_checked, fails in stored:
+            ip, _, port = key.rpartition(':')
+            try:
+                cid = pack_key(ip, port) << 4 | PROTO_BITS[proto]
+            except (ValueError, KeyError):
+                continue
+            r = self._row(cid, first_seen or 0.0, source)
+            self.last_seen[r] = last_seen or 0.0
+            self.last_live[r] = last_live or 0.0
+            self.last_checked[r] = last_checked or 0.0
+            self.fails[r] = min(fails or 0, 0xFFFF)
+            self.dirty[r] = 0
+        logger.info(f"💾 Health store: {len(self)} bản ghi")
+
+    def _find(self, cid: int) -> int:
+        r = self.index.get(cid >> 4, -1)
+        bit = cid & 15
+        while r >= 0 and self.bits[r] != bit:
+            r = self.next[r]
+        return r
+
+    def _row(self, cid: int, now: float, source: Optional[str] = None, ikey: Optional[int] = None) -> int:
+        """Dòng của cid, tạo mới nếu chưa có (ikey: truyền object key sẵn có để chỉ mục dùng chung)"""
+        r = self._find(cid)
+        if r >= 0:
+            return r
+        if ikey is None:
+            ikey = cid >> 4
+        sid = 0
+        if source:
+            sid = self.source_ids.get(source, 0)
+            if not sid and len(self.sources) <= 0xFFFF:
+                sid = self.source_ids[source] = len(self.sources)
+                self.sources.append(source)
+        r = len(self.bits)
+        self.bits.append(cid & 15)
+        self.next.append(self.index.get(ikey, -1))
+        self.index[ikey] = r
+        self.first_seen.append(now)
+        self.last_seen.append(now)
+        self.last_live.append(0.0)
+        self.last_checked.append(0.0)
+        self.fails.append(0)
+        self.first_source.append(sid)
+        self.dirty.append(1)
+        return r
+
+    def seen(self, cid: int, source: str, now: float, ikey: Optional[int] = None):
+        r = self._row(cid, now, source, ikey)
+        if now - self.last_seen[r] >= HEALTH_SEEN_RESOLUTION:
+            self.last_seen[r] = now
+            self.dirty[r] = 1
+
+    def should_check(self, cid: int, now: float) -> bool:
+        """Backoff luỹ thừa với proxy chết liên tục"""
+        r = self._find(cid)
+        if r < 0 or self.fails[r] < HEALTH_GRACE_FAILS:
+            return True
+        delay = min(HEALTH_BACKOFF_BASE * 2 ** (self.fails[r] - HEALTH_GRACE_FAILS), HEALTH_BACKOFF_MAX)
+        return now - self.last_checked[r] >= delay
+
+    def priority(self, cid: int) -> float:
+        """Càng nhỏ càng được kiểm tra sớm: live gần đây → chưa biết → fail nhiều"""
+        r = self._find(cid)
+        if r < 0:
+            return 0.0
+        if self.last_live[r]:
+            return -self.last_live[r]
+        return float(self.fails[r])
+
+    def checked_ago(self, cid: int, now: float) -> float:
+        r = self._find(cid)
+        return now - self.last_checked[r] if r >= 0 else float('inf')
+
+    def checked_since(self, ikey: int, since: float) -> bool:
+        """Key có protocol nào được kiểm tra từ thời điểm since không"""
+        r = self.index.get(ikey, -1)
+        while r >= 0 and self.last_checked[r] < since:
+            r = self.next[r]
+        return r >= 0
+
+    def failed_recently(self, cid: int, now: float) -> bool:
+        r = self._find(cid)
+        return r >= 0 and self.fails[r] > 0 and now - self.last_checked[r] < UNCHANGED_RECHECK_AFTER
+
+    def record(self, cid: int, is_live: bool, now: float):
+        if self.journal is not None:
+            self.journal.append((cid, is_live, now))
+            return
+        r = self._row(cid, now)
+        self.last_checked[r] = now
+        if is_live:
+            self.last_live[r] = now
+            self.fails[r] = 0
+        elif self.fails[r] < 0xFFFF:
+            self.fails[r] += 1
+        self.dirty[r] = 1
+
+    def rows(self, heads: Optional[List[Tuple[int, int]]] = None):
+        """Duyệt (cid, dòng) của mọi bản ghi (heads: bản chụp index.items() khi duyệt ngoài event loop)"""
+        bits, nxt = self.bits, self.next
+        for ikey, r in self.index.items() if heads is None else heads:
+            while r >= 0:
+                yield ikey << 4 | bits[r], r
+                r = nxt[r]
+
+    def stale_keys(self, cutoff: float) -> List[int]:
+        """Key mà mọi protocol đều không được nguồn nào liệt kê kể từ cutoff"""
+        stale = []
+        last_seen, nxt = self.last_seen, self.next
+        for ikey, r in self.index.items():
+            while r >= 0 and last_seen[r] < cutoff:
+                r = nxt[r]
+            if r < 0:
+                stale.append(ikey)
+        return stale
+
+    def forget(self, ikeys: List[int]):
+        """Bỏ bản ghi của các key khỏi bộ nhớ (SQLite giữ nguyên); nén mảng khi quá nửa số dòng là rác"""
+        for ikey in ikeys:
+            r = self.index.pop(ikey, -1)
+            while r >= 0:
+                self.garbage += 1
+                r = self.next[r]
+        if self.garbage * 2 > len(self.bits):
+            self._compact()
+
+    def _compact(self):
+        old = {name: getattr(self, name) for name in self.COLUMNS}
+        old_next = self.next
+        for name, column in old.items():
+            setattr(self, name, column[:0])
+        self.next = old_next[:0]
+        index, self.index = self.index, {}
+        for ikey, r in index.items():
+            head = -1
+            while r >= 0:
+                for name, column in old.items():
+                    getattr(self, name).append(column[r])
+                self.next.append(head)
+                head = len(self.next) - 1
+                r = old_next[r]
+            self.index[ikey] = head
+        self.garbage = 0
+
+    def save(self, heads: Optional[List[Tuple[int, int]]] = None):
+        cutoff = time.time() - HEALTH_PRUNE_AFTER
+        dirty = []
+        for cid, r in self.rows(heads):
+            if self.dirty[r]:
+                # Xoá cờ trước khi đọc giá trị: thay đổi xen giữa (từ event loop) sẽ được ghi ở lần sau
+                self.dirty[r] = 0
+                dirty.append((cid, r))
+        try:
+            with sqlite3.connect(self.path) as conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO health VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (("%s:%d" % unpack_key(cid >> 4), BIT_PROTOS[cid & 15], self.first_seen[r],
+                      self.sources[self.first_source[r]], self.last_seen[r], self.last_live[r],
+                      self.last_checked[r], self.fails[r]) for cid, r in dirty)
+                )
+                conn.execute("DELETE FROM health WHERE last_seen < ?", (cutoff,))
+            logger.info(f"💾 Đã lưu {len(dirty)} bản ghi vào health store")
+        except sqlite3.Error as e:
+            logger.error(f"Lỗi ghi health store: {e}")
+            for _, r in dirty:
+                self.dirty[r] = 1
+
+    async def save_async(self):
+        """Daemon: ghi trong thread pool để event loop không bị chặn. Chỉ mục được chụp trước;
+        số dòng không đổi trong lúc ghi vì chỉ evict_stale (chạy sau bước này) mới nén mảng"""
+        heads = list(self.index.items())
+        await asyncio.get_running_loop().run_in_executor(None, self.save, heads)
+
+
+class CandidatePrior:
+    """Điểm tiên nghiệm 0..1 cho proxy chưa từng live gần đây, dùng để xếp thứ tự kiểm tra.
+
+    Dựa trên lịch sử trong health store: tỉ lệ proxy live của nguồn, mạng /24 (hoặc /16) vừa có proxy live;
+    cộng thêm protocol được nguồn ghi rõ và port proxy phổ biến.
+    """
+    W_SOURCE, W_NET, W_LABELED, W_PORT = 0.4, 0.3, 0.15, 0.15
+
+    def __init__(self):
+        self.source_yield: Dict[str, float] = {}
+        self.live24: Set[int] = set()
+        self.live16: Set[int] = set()
+
+    def build(self, health: 'HealthStore', now: float, source_stats: Optional['SourceStats'] = None):
+        totals: Dict[str, int] = {}
+        lives: Dict[str, int] = {}
+        for cid, r in health.rows():
+            source = health.sources[health.first_source[r]]
+            last_live = health.last_live[r]
+            is_live = bool(last_live) and now - last_live < PRIOR_LIVE_WINDOW
+            if source:
+                totals[source] = totals.get(source, 0) + 1
+                if is_live:
+                    lives[source] = lives.get(source, 0) + 1
+            if is_live:
+                ip = cid >> 20
+                self.live24.add(ip >> 8)
+                self.live16.add(ip >> 16)
+        # Làm trơn để nguồn ít dữ liệu không bị đánh giá quá cao/thấp, rồi chuẩn hoá theo nguồn tốt nhất
+        rates = {source: (lives.get(source, 0) + 1) / (total + 20) for source, total in totals.items()}
+        if source_stats:
+            # Thống kê nguồn (live / ứng viên của các lần chạy gần đây) chính xác hơn first_source của health store
+            for source, entry in source_stats.entries.items():
+                if entry.get('candidates'):
+                    rates[source] = (0.0 if source_stats.demoted(source)
+                                     else (entry['live'] + 1) / (source_stats.checked(source) + 20))
+        best = max(rates.values(), default=0)
+        self.source_yield = {source: rate / best for source, rate in rates.items()} if best else {}
+
+    def score(self, ikey: int, mask: int, source: Optional[str]) -> float:
+        ip = ikey >> 16
+        net = 1.0 if ip >> 8 in self.live24 else 0.5 if ip >> 16 in self.live16 else 0.0
+        return (self.W_SOURCE * self.source_yield.get(source, 0.5)
+                + self.W_NET * net
+                + self.W_LABELED * (len(MASK_BITS[mask]) == 1)
+                + self.W_PORT * ((ikey & 0xFFFF) in COMMON_PROXY_PORTS))
+
+
+class SourceParser:
+    """Parse payload nguồn theo từng chunk bytes.
+
+    Fast path cho dòng 'ip:port' thuần (đa số nguồn): 1 regex neo theo dòng chạy trên cả chunk,
+    octet được kiểm tra phạm vi ngay trong regex. Chỉ dòng khác mới chạy PROXY_RE đầy đủ.
+    Mỗi proxy mới (hoặc protocol mới của proxy đã có) trong nguồn được báo qua
+    on_proxy(key, ip, port, protocols, username, password).
+
+    Kết quả giữ dạng gọn: key → tuple protocol dùng chung, credentials ở bảng riêng.
+    """
+    __slots__ = ('default_protocols', 'on_proxy', 'protocols', 'credentials', '_tail')
+
+    def __init__(self, default_protocols: List[str], on_proxy=None):
+        self.default_protocols = tuple(default_protocols)
+        self.on_proxy = on_proxy
+        self.protocols: Dict[str, Tuple[str, ...]] = {}
+        self.credentials: Dict[str, Tuple[str, str]] = {}
+        self._tail = b''
+
+    def feed(self, chunk: bytes):
+        data = self._tail + chunk if self._tail else chunk
+        cut = data.rfind(b'\n') + 1
+        self._tail = data[cut:]
+        if cut:
+            # latin-1: decode 1-1 theo byte, không bao giờ lỗi và không cắt ngang ký tự nhiều byte
+            self._parse(data[:cut].decode('latin-1'))
+
+    def close(self):
+        if self._tail:
+            self._parse(self._tail.decode('latin-1'))
+            self._tail = b''
+
+    def result(self) -> Dict[str, Any]:
+        """{'groups': {"http,socks5": [key, ...]}, 'credentials': {key: [username, password]}}"""
+        groups: Dict[str, List[str]] = {}
+        for key, protos in self.protocols.items():
+            groups.setdefault(','.join(protos), []).append(key)
+        return {'groups': groups, 'credentials': {k: list(v) for k, v in self.credentials.items()}}
+
+    def _parse(self, text: str):
+        known = self.protocols
+        defaults = self.default_protocols
+        on_proxy = self.on_proxy
+        for key, ip, port, other in PLAIN_LINE_RE.findall(text):
+            if key:
+                if not 0 < int(port) <= 65535:
+                    continue
+                if key not in known:
+                    known[key] = defaults
+                    if on_proxy:
+                        on_proxy(key, ip, port, defaults, None, None)
+                else:
+                    self._add(key, ip, port, defaults, None, None)
+            elif other:
+                self._parse_fallback(other)
+
+    def _parse_fallback(self, line: str):
+        for match in PROXY_RE.finditer(line):
+            ip, port = match.group('ip'), match.group('port')
+            if not 0 < int(port) <= 65535 or any(int(o) > 255 for o in ip.split('.')):
+                continue
+            proto = match.group('protocol')
+            username, password = match.group('username'), match.group('password')
+            self._add(
+                f"{ip}:{port}", ip, port,
+                (proto.lower(),) if proto else self.default_protocols,
+                username.encode('latin-1').decode('utf-8', errors='replace') if username else None,
+                password.encode('latin-1').decode('utf-8', errors='replace') if password else None,
+            )
+
+    def _add(self, key: str, ip: str, port: str, protocols: Tuple[str, ...],
+             username: Optional[str], password: Optional[str]):
+        current = self.protocols.get(key)
+        if current is None:
+            self.protocols[key] = protocols
+            new_protos = protocols
+        else:
+            new_protos = tuple(p for p in protocols if p not in current)
+            if not new_protos:
+                return
+            self.protocols[key] = current + new_protos
+        if username and password and key not in self.credentials:
+            self.credentials[key] = (username, password)
+        if self.on_proxy:
+            self.on_proxy(key, ip, port, new_protos, username, password)
+
+
+class SourceCache:
+    """ETag / Last-Modified / hash nội dung và danh sách proxy đã parse của từng nguồn"""
+
+    def __init__(self, path: str = SOURCE_CACHE):
+        self.path = path
+        self.entries: Dict[str, Dict[str, Any]] = {}
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = {url: e for url, e in json.load(f).items() if 'parsed' in e}
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"Không đọc được cache nguồn '{self.path}': {e}")
+
+    def update(self, url: str, headers: Any, digest: str, parsed: Dict[str, Any], ignores_conditional: bool = False):
+        self.entries[url] = {
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'sha256': digest,
+            'parsed': parsed,
+        }
+        if ignores_conditional:
+            # Server bỏ qua If-None-Match / If-Modified-Since (trả 200 với nội dung y hệt)
+            self.entries[url]['ignores_conditional'] = True
+
+    def save(self, sources: List[str]):
+        wanted = set(sources)
+        self.entries = {url: entry for url, entry in self.entries.items() if url in wanted}
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f, separators=(',', ':'))
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.error(f"Lỗi ghi cache nguồn: {e}")
+
+
+class SourceStats:
+    """Hiệu quả của từng nguồn qua các lần chạy (EWMA): byte tải, thời gian tải, số ứng viên,
+    số ứng viên chỉ nguồn này có, số ứng viên thực sự được kiểm tra và số proxy live đóng góp"""
+
+    def __init__(self, path: str = SOURCE_STATS):
+        self.path = path
+        self.entries: Dict[str, Dict[str, float]] = {}
+        # Lần chạy hiện tại
+        self.fetched: Dict[str, Tuple[int, float]] = {}     # url -> (byte đã tải, giây)
+        self.reused: Set[str] = set()                       # nguồn dùng lại danh sách đã cache
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"Không đọc được thống kê nguồn '{self.path}': {e}")
+
+    def save(self, sources: List[str]):
+        wanted = set(sources)
+        self.entries = {url: entry for url, entry in self.entries.items() if url in wanted}
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f, separators=(',', ':'))
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.error(f"Lỗi ghi thống kê nguồn: {e}")
+
+    def record_fetch(self, url: str, nbytes: int, seconds: float):
+        self.fetched[url] = (nbytes, seconds)
+
+    def update(self, url: str, candidates: int, unique: int, checked: int, live: int, now: float,
+               complete: bool = True):
+        """complete=False: lần chạy bị cắt giữa chừng, không tính là lần chạy "khô" nếu không có proxy live"""
+        entry = self.entries.setdefault(url, {'runs': 0, 'dry_runs': 0, 'skipped': 0})
+        values = {'candidates': candidates, 'unique': unique, 'checked': checked, 'live': live}
+        if url in self.fetched:
+            # Lần chạy dùng lại cache không tốn byte nào, không tính vào chi phí tải
+            nbytes, seconds = self.fetched[url]
+            values['bytes'], values['fetch_ms'] = nbytes, seconds * 1000
+        for field, value in values.items():
+            old = entry.get(field)
+            entry[field] = round(value if old is None else old + SOURCE_STATS_ALPHA * (value - old), 3)
+        entry['runs'] += 1
+        if live:
+            entry['dry_runs'] = 0
+        elif complete:
+            entry['dry_runs'] += 1
+        if live:
+            entry['last_live'] = int(now)
+
+    def _judged(self, url: str) -> Optional[Dict[str, float]]:
+        entry = self.entries.get(url)
+        return entry if entry and entry['runs'] >= SOURCE_MIN_RUNS else None
+
+    def dying(self, url: str) -> bool:
+        entry = self._judged(url)
+        return entry is not None and entry['dry_runs'] >= SOURCE_DIE_DRY_RUNS
+
+    def checked(self, url: str) -> float:
+        """Mẫu số của tỉ lệ live: số ứng viên đã kiểm tra (thống kê cũ chưa có thì dùng số ứng viên)"""
+        entry = self.entries[url]
+        return entry.get('checked', entry['candidates'])
+
+    def demoted(self, url: str) -> bool:
+        entry = self._judged(url)
+        return entry is not None and entry['live'] < SOURCE_DEMOTE_YIELD * self.checked(url)
+
+    def throttled(self, url: str) -> bool:
+        entry = self._judged(url)
+        if entry is None:
+            return False
+        live_per_mb = entry['live'] / max(entry.get('bytes', 0), 1) * 2 ** 20
+        return (self.dying(url) or live_per_mb < SOURCE_THROTTLE_LIVE_PER_MB
+                or entry['unique'] < SOURCE_THROTTLE_UNIQUE * entry['candidates'])
+
+    def skip_fetch(self, url: str) -> bool:
+        """Nguồn tải thưa: chỉ tải 1 trong (SOURCE_THROTTLE_SKIP + 1) lần chạy"""
+        if not self.throttled(url):
+            return False
+        entry = self.entries[url]
+        if entry['skipped'] >= SOURCE_THROTTLE_SKIP:
+            entry['skipped'] = 0
+            return False
+        entry['skipped'] += 1
+        return True
+
+
+class TestTarget:
+    """1 đích kiểm tra với request byte đóng gói sẵn cho từng protocol"""
+    __slots__ = ('host', 'port', 'ip', 'resolved_at', 'http_head', 'http_connect',
+                 'socks5_connect', 'socks4_connect', 'ok', 'fail', 'disabled', 'disabled_at')
+
+    def __init__(self, host: str, port: int):
+        self.host, self.port = host, port
+        self.ip: Optional[str] = None
+        self.resolved_at = 0.0
+        self.http_head = f"CONNECT {host}:{port} HTTP/1.1\r\nHost: {host}:{port}\r\n".encode()
+        self.http_connect = self.http_head + b"Connection: close\r\n\r\n"
+        domain = host.encode()
+        self.socks5_connect = b'\x05\x01\x00\x03' + bytes([len(domain)]) + domain + port.to_bytes(2, 'big')
+        # Chưa resolve được thì dùng SOCKS4a (proxy tự resolve domain)
+        self.socks4_connect = b'\x04\x01' + port.to_bytes(2, 'big') + b'\x00\x00\x00\x01\x00' + domain + b'\x00'
+        self.ok = self.fail = 0
+        self.disabled = False
+        self.disabled_at = 0.0
+
+    def set_ip(self, ip: str, now: float):
+        self.ip, self.resolved_at = ip, now
+        self.socks4_connect = b'\x04\x01' + self.port.to_bytes(2, 'big') + socket.inet_aton(ip) + b'\x00'
+
+    def http_request(self, auth_header: str) -> bytes:
+        if not auth_header:
+            return self.http_connect
+        return self.http_head + auth_header.encode() + b"Connection: close\r\n\r\n"
+
+
+class TargetPool:
+    """Resolve đích kiểm tra 1 lần (không chặn event loop), cache theo TTL và xoay vòng giữa các đích"""
+
+    def __init__(self, specs: List[str]):
+        self.targets: List[TestTarget] = []
+        for spec in specs:
+            host, _, port = spec.rpartition(':')
+            self.targets.append(TestTarget(host, int(port)))
+        self._next = 0
+
+    async def resolve(self):
+        loop = asyncio.get_running_loop()
+        now = time.time()
+
+        async def _resolve(target: TestTarget):
+            try:
+                infos = await loop.getaddrinfo(target.host, target.port, family=socket.AF_INET, type=socket.SOCK_STREAM)
+                target.set_ip(infos[0][4][0], now)
+            except Exception as e:
+                # Giữ IP cũ (nếu có); SOCKS4 tự chuyển sang SOCKS4a
+                logger.warning(f"Không resolve được đích kiểm tra {target.host}: {e}")
+
+        await asyncio.gather(*[_resolve(t) for t in self.targets if now - t.resolved_at >= TARGET_DNS_TTL])
+
+    async def refresher(self):
+        while True:
+            await asyncio.sleep(TARGET_DNS_TTL)
+            await self.resolve()
+
+    def next(self) -> TestTarget:
+        for _ in range(len(self.targets)):
+            target = self.targets[self._next]
+            self._next = (self._next + 1) % len(self.targets)
+            if target.disabled and time.time() - target.disabled_at >= TARGET_DISABLE_COOLDOWN:
+                logger.info(f"🎯 Dùng lại đích kiểm tra {target.host} sau {TARGET_DISABLE_COOLDOWN}s tạm ngưng")
+                target.disabled = False
+                target.ok = target.fail = 0
+            if not target.disabled:
+                return target
+        return self.targets[0]
+
+    def report(self, target: TestTarget, ok: bool):
+        """Ghi nhận kết quả handshake (đã TCP connect được tới proxy) để phát hiện đích bị chặn/sập"""
+        if ok:
+            target.ok += 1
+        else:
+            target.fail += 1
+        if (target.ok + target.fail) % TARGET_MIN_SAMPLES:
+            return
+        rates = [t.ok / (t.ok + t.fail) for t in self.targets if t.ok + t.fail >= TARGET_MIN_SAMPLES]
+        best = max(rates) if rates else 0
+        for t in self.targets:
+            total = t.ok + t.fail
+            if total >= TARGET_MIN_SAMPLES and best > 0:
+                disabled = t.ok / total < best * TARGET_DISABLE_RATIO
+                if disabled and not t.disabled:
+                    logger.warning(f"⚠️ Tạm ngưng đích kiểm tra {t.host}: tỉ lệ thành công {t.ok / total:.1%}")
+                    t.disabled_at = time.time()
+                t.disabled = disabled
+
+
+class ConcurrencyController:
+    """Giới hạn số check đang chạy theo AIMD: tăng dần khi ổn định, giảm mạnh khi thấy quá tải.
+
+    Dấu hiệu quá tải: thời gian connect của các endpoint có trả lời tăng so với mức nền, lỗi tài nguyên
+    cục bộ (EMFILE/ENOBUFS...) và độ trễ của event loop. Không dùng tỉ lệ timeout: tỉ lệ này tăng mạnh
+    khi hàng đợi chuyển sang phần proxy chưa biết / đã chết (thứ tự ưu tiên), không phải do nghẽn.
+    """
+    RESOURCE_ERRNOS = {errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.EADDRNOTAVAIL, errno.ENOMEM}
+
+    def __init__(self, maximum: int = MAX_CONCURRENT):
+        self.maximum = maximum
+        self.limit = min(CONCURRENCY_START, maximum)
+        self.in_flight = 0
+        self._waiters: deque = deque()
+        self.resource_errors = 0
+        self.connect_times: List[float] = []
+        self.medians: deque = deque(maxlen=CONNECT_RTT_WINDOW)
+        self.loop_lag = 0.0
+
+    async def __aenter__(self):
+        while self.in_flight >= self.limit:
+            fut = asyncio.get_running_loop().create_future()
+            self._waiters.append(fut)
+            await fut
+        self.in_flight += 1
+
+    async def __aexit__(self, *exc):
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        free = self.limit - self.in_flight
+        while free > 0 and self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                free -= 1
+
+    def record(self, exc: Optional[BaseException], connect_time: float = 0.0):
+        """Ghi nhận kết quả TCP connect (connect_time: giây, khi connect thành công)"""
+        if exc is None:
+            self.connect_times.append(connect_time)
+        elif isinstance(exc, OSError) and exc.errno in self.RESOURCE_ERRNOS:
+            self.resource_errors += 1
+
+    def adjust(self, lag: float):
+        self.loop_lag = lag
+        old = self.limit
+        median = None
+        if self.resource_errors or lag > LOOP_LAG_LIMIT:
+            self.limit = max(CONCURRENCY_MIN, int(self.limit * CONCURRENCY_BACKOFF))
+        elif len(self.connect_times) >= ADAPT_MIN_SAMPLES:
+            self.connect_times.sort()
+            median = self.connect_times[len(self.connect_times) // 2]
+            baseline = min(self.medians, default=median)
+            if median > baseline * CONNECT_RTT_FACTOR + CONNECT_RTT_SLACK:
+                self.limit = max(CONCURRENCY_MIN, int(self.limit * CONCURRENCY_BACKOFF))
+            else:
+                self.limit = min(self.maximum, self.limit + CONCURRENCY_STEP)
+            self.medians.append(median)
+        else:
+            # Ít mẫu (ví dụ đang chờ nguồn) — giữ nguyên
+            return
+        if self.limit < old:
+            connect = f"{median * 1000:.0f}ms" if median is not None else "-"
+            logger.debug(f"AIMD: {old} → {self.limit} (connect={connect}, lag={lag * 1000:.0f}ms, "
+                         f"resource errors={self.resource_errors})")
+        self.connect_times.clear()
+        self.resource_errors = 0
+        self._wake()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(ADAPT_INTERVAL)
+            self.adjust(loop.time() - started - ADAPT_INTERVAL)
+
+
+# Phân loại nhà mạng theo tên ISP (thứ tự ưu tiên từ trên xuống, không khớp → business)
+USER_TYPE_KEYWORDS = [
+    ('hosting', ['vps', 'hosting', 'server', 'cloud', 'datacenter', 'digitalocean', 'amazon', 'google', 'ovh', 'hetzner']),
+    ('cellular', ['mobile', 'wireless', 'cellular', 't-mobile', 'vodafone']),
+    ('residential', ['telecom', 'viettel', 'fpt', 'vnpt', 'comcast', 'broadband', 'dsl', 'cable']),
+]
+USER_TYPE_RES = [(user_type, re.compile('|'.join(map(re.escape, kws)))) for user_type, kws in USER_TYPE_KEYWORDS]
+
+
+class GeoEnricher:
+    """Tra cứu quốc gia / ASN từ MMDB (memory-mapped).
+    Cache theo /24 (1 cặp lookup cho cả dải), theo ASN và theo tên ISP (phân loại 1 lần)."""
+
+    def __init__(self, country_db: str = DB_COUNTRY, asn_db: str = DB_ASN):
+        self.country_db = country_db
+        self.asn_db = asn_db
+        self.reader_country = None
+        self.reader_asn = None
+        self.prefixes: Dict[str, Tuple[Optional[str], Optional[str], Optional[int]]] = {}
+        self.asns: Dict[int, Tuple[str, str]] = {}
+        self.user_types: Dict[str, str] = {}
+
+    def open(self) -> bool:
+        if not os.path.exists(self.country_db) or not os.path.exists(self.asn_db):
+            logger.warning("Không thấy file DB GeoIP. Bỏ qua định vị.")
+            return False
+        try:
+            self.reader_country = geoip2.database.Reader(self.country_db, mode=geoip2.database.MODE_MMAP)
+            self.reader_asn = geoip2.database.Reader(self.asn_db, mode=geoip2.database.MODE_MMAP)
+        except Exception as e:
+            logger.error(f"Lỗi mở DB GeoIP: {e}")
+            self.close()
+            return False
+        return True
+
+    def close(self):
+        for reader in (self.reader_country, self.reader_asn):
+            if reader:
+                reader.close()
+        self.reader_country = self.reader_asn = None
+
+    def classify(self, isp: str) -> str:
+        user_type = self.user_types.get(isp)
+        if user_type is None:
+            name = isp.lower()
+            user_type = next((t for t, pattern in USER_TYPE_RES if pattern.search(name)), 'business')
+            self.user_types[isp] = user_type
+        return user_type
+
+    def lookup_prefix(self, ip: str) -> Tuple[Optional[str], Optional[str], Optional[int]]:
+        prefix = ip[:ip.rfind('.')]
+        cached = self.prefixes.get(prefix)
+        if cached is not None:
+            return cached
+        country = code = asn = None
+        try:
+            c_res = self.reader_country.country(ip)
+            country, code = c_res.country.name, c_res.country.iso_code
+        except Exception:
+            pass
+        try:
+            a_res = self.reader_asn.asn(ip)
+            asn = a_res.autonomous_system_number
+            if asn is not None and asn not in self.asns:
+                isp = a_res.autonomous_system_organization or 'Unknown'
+                self.asns[asn] = (isp, self.classify(isp))
+        except Exception:
+            pass
+        cached = self.prefixes[prefix] = (country, code, asn)
+        return cached
+
+    def enrich(self, proxies: List[Dict[str, Any]]):
+        """Chạy trong thread pool: chỉ ghi các trường địa lý, không đụng tới trường đo đạc"""
+        for proxy in proxies:
+            country, code, asn = self.lookup_prefix(proxy['ip'])
+            if country:
+                proxy['country'] = country
+            if code:
+                proxy['countryCode'] = code
+            if asn is not None:
+                proxy['asn'] = asn
+                proxy['isp'], proxy['user_type'] = self.asns[asn]
+
+
+def failure_reason(exc: BaseException, connect: bool = False) -> str:
+    """Phân loại lỗi của 1 check: connect_timeout / handshake_timeout / refused / unreachable /
+    reset / closed / local_resource / error. Lỗi ở tầng giao thức (bad_reply, auth_rejected)
+    do các hàm handshake tự trả về."""
+    if isinstance(exc, asyncio.TimeoutError):
+        return 'connect_timeout' if connect else 'handshake_timeout'
+    if isinstance(exc, ConnectionRefusedError):
+        return 'refused'
+    if isinstance(exc, (ConnectionResetError, ConnectionAbortedError, BrokenPipeError)):
+        return 'reset'
+    if isinstance(exc, asyncio.IncompleteReadError):
+        return 'closed'
+    if isinstance(exc, OSError):
+        if exc.errno in ConcurrencyController.RESOURCE_ERRNOS:
+            return 'local_resource'
+        if connect:
+            return 'unreachable'
+    return 'error'
+
+
+class CheckResult:
+    """Kết quả 1 lượt kiểm tra: protocol live (nếu có), các protocol đã thử, thời gian đo được
+    và lý do thất bại (xem failure_reason)"""
+    __slots__ = ('proto', 'tried', 'reachable', 'connect_ms', 'handshake_ms', 'speed_kbps', 'failure')
+
+    def __init__(self, proto: Optional[str], tried: List[str], reachable: bool,
+                 connect_ms: float = 0.0, handshake_ms: float = 0.0, failure: Optional[str] = None):
+        self.proto = proto
+        self.tried = tried
+        self.reachable = reachable
+        self.connect_ms = connect_ms
+        self.handshake_ms = handshake_ms
+        self.speed_kbps: Optional[float] = None
+        self.failure = failure
+
+
+LINGER_ZERO = struct.pack('ii', 1, 0)
+
+
+class HandshakeProtocol(asyncio.Protocol):
+    """Engine 'protocol': handshake HTTP CONNECT / SOCKS5 / SOCKS4 như 1 state machine trên data_received.
+
+    Không tạo StreamReader/StreamWriter, không task hay timer riêng cho từng bước; byte request lấy sẵn
+    từ TestTarget. Kết quả (None = live, ngược lại là lý do lỗi) được đặt vào future `done`.
+    """
+    __slots__ = ('mode', 'target', 'username', 'password', 'done', 'transport', 'state', 'buffer', 'answered')
+
+    SOCKS5_GREETING = b'\x05\x01\x00'
+    SOCKS5_GREETING_AUTH = b'\x05\x02\x00\x02'
+
+    def __init__(self, proto: str, target: TestTarget, username: Optional[str], password: Optional[str],
+                 done: asyncio.Future):
+        self.mode = 'http' if proto in ('http', 'https') else proto
+        self.target = target
+        self.username, self.password = username, password
+        self.done = done
+        self.transport: Optional[asyncio.Transport] = None
+        self.state = 0
+        self.buffer = b""
+        self.answered = False       # endpoint trả lời đúng kiểu protocol đang thử (dùng khi dò protocol)
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        if self.mode == 'http':
+            transport.write(self.target.http_request(ProxyFetcher._build_auth_header(self.username, self.password)))
+        elif self.mode == 'socks5':
+            transport.write(self.SOCKS5_GREETING_AUTH if self.username and self.password else self.SOCKS5_GREETING)
+        else:
+            transport.write(self.target.socks4_connect)
+
+    def _finish(self, failure: Optional[str]):
+        if not self.done.done():
+            self.done.set_result(failure)
+
+    def data_received(self, data: bytes):
+        if self.done.done():
+            return
+        buf = self.buffer + data if self.buffer else data
+        if self.mode == 'http':
+            if not b"HTTP/".startswith(buf[:5]):
+                return self._finish('bad_reply')
+            if b"\r\n" not in buf and len(buf) < 1024:
+                self.buffer = buf
+                return
+            self.answered = True
+            return self._finish(ProxyFetcher._http_failure(buf))
+        if self.mode == 'socks4':
+            if len(buf) < 2:
+                self.buffer = buf
+                return
+            self.answered = True
+            return self._finish(None if buf[1] == 0x5A else 'bad_reply')
+
+        # SOCKS5: 0 = chờ chọn method, 1 = chờ kết quả auth, 2 = chờ phản hồi CONNECT
+        if self.state == 0 and buf[0] != 0x05:
+            return self._finish('bad_reply')
+        if len(buf) < 2:
+            self.buffer = buf
+            return
+        self.buffer = b""
+        if self.state == 0:
+            self.answered = True
+            method = buf[1]
+            if method == 0xFF or (method == 0x02 and not (self.username and self.password)):
+                return self._finish('auth_rejected')
+            if method == 0x02:
+                self.state = 1
+                self.transport.write(
+                    b'\x01' + bytes([len(self.username)]) + self.username.encode()
+                    + bytes([len(self.password)]) + self.password.encode()
+                )
+                return
+            self.state = 2
+            self.transport.write(self.target.socks5_connect)
+        elif self.state == 1:
+            if buf[1] != 0x00:
+                return self._finish('auth_rejected')
+            self.state = 2
+            self.transport.write(self.target.socks5_connect)
+        else:
+            self._finish(None if buf[1] == 0x00 else 'bad_reply')
+
+    def eof_received(self):
+        self._finish('closed')
+
+    def connection_lost(self, exc: Optional[BaseException]):
+        self._finish(failure_reason(exc) if exc else 'closed')
+
+    def abort(self):
+        """Đóng ngay với SO_LINGER 0: gửi RST, không chờ đóng, không để lại TIME_WAIT"""
+        if self.transport is None:
+            return
+        try:
+            self.transport.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, LINGER_ZERO)
+        except Exception:
+            pass
+        self.transport.abort()
+
+
+class RateBudget:
+    """Token bucket: giới hạn số check được bắt đầu mỗi giây để tải đều thay vì dồn thành đợt.
+
+    Waiter xếp hàng theo khoá ưu tiên (nhỏ trước, cùng khoá thì FIFO) và chỉ chờ future của mình;
+    1 timer duy nhất phát token khi bucket đầy lại, nên số waiter không làm tốn thêm CPU."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.capacity = max(1.0, rate / 10)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.waiters: List[Tuple[Tuple, int, asyncio.Future]] = []
+        self.seq = 0
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, priority: Tuple = ()):
+        if not self.waiters:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+        self.seq += 1
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, self.seq, waiter))
+        self._schedule()
+        await waiter            # bị huỷ khi đang chờ → _dispatch bỏ qua mục này
+
+    def _schedule(self):
+        if self.timer is None and self.waiters:
+            self._refill()
+            delay = max(0.0, (1 - self.tokens) / self.rate)
+            self.timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+    def _dispatch(self):
+        self.timer = None
+        self._refill()
+        while self.waiters and self.tokens >= 1:
+            _, _, waiter = heapq.heappop(self.waiters)
+            if not waiter.done():
+                self.tokens -= 1
+                waiter.set_result(None)
+        self._schedule()
+
+
+class RunMetrics:
+    """Số liệu của 1 lần chạy: thời gian từng phase, histogram thời gian check, số check theo
+    protocol, lý do thất bại, độ trễ event loop và số FD mở tối đa"""
+    LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 1500, 2500, 5000)
+
     def __init__(self):
-        self.raw_proxies: Dict[str, Dict[str, Any]] = {}
-        self.live_proxies: Dict[str, Dict[str, Any]] = {}
-        self.failed_ips: Set[str] = set()
+        self.started_at = datetime.utcnow()
+        self.phases: Dict[str, float] = {}
+        self.latency_buckets = [0] * (len(self.LATENCY_BUCKETS_MS) + 1)
+        self.latency_sum_ms = 0.0
+        self.protocols: Dict[str, Dict[str, int]] = {}
+        self.failures: Dict[str, int] = {}
+        self.source_errors: Dict[str, int] = {}
+        self.loop_lag_max = 0.0
+        self.loop_lag_total = 0.0
+        self.loop_lag_samples = 0
+        self.peak_fds = 0
+
+    @contextlib.contextmanager
+    def timed(self, phase: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - started)
+
+    def add_time(self, phase: str, seconds: float):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def record_check(self, result: CheckResult, seconds: float):
+        for proto in result.tried:
+            counts = self.protocols.setdefault(proto, {'live': 0, 'dead': 0})
+            counts['live' if proto == result.proto else 'dead'] += 1
+        if result.proto is None:
+            reason = result.failure or 'error'
+            self.failures[reason] = self.failures.get(reason, 0) + 1
+        ms = seconds * 1000
+        self.latency_buckets[bisect.bisect_left(self.LATENCY_BUCKETS_MS, ms)] += 1
+        self.latency_sum_ms += ms
+
+    def record_source_error(self, reason: str):
+        self.source_errors[reason] = self.source_errors.get(reason, 0) + 1
+
+    def merge(self, other: 'RunMetrics'):
+        """Gộp số liệu check từ process con (chế độ shard)"""
+        for i, count in enumerate(other.latency_buckets):
+            self.latency_buckets[i] += count
+        self.latency_sum_ms += other.latency_sum_ms
+        for proto, counts in other.protocols.items():
+            mine = self.protocols.setdefault(proto, {'live': 0, 'dead': 0})
+            mine['live'] += counts['live']
+            mine['dead'] += counts['dead']
+        for reason, count in other.failures.items():
+            self.failures[reason] = self.failures.get(reason, 0) + count
+        self.loop_lag_max = max(self.loop_lag_max, other.loop_lag_max)
+        self.loop_lag_total += other.loop_lag_total
+        self.loop_lag_samples += other.loop_lag_samples
+        # FD của các process cộng lại: cận trên của tổng FD toàn hệ thống
+        self.peak_fds += other.peak_fds
+
+    @staticmethod
+    def open_fds() -> int:
+        try:
+            return len(os.listdir('/proc/self/fd'))
+        except OSError:
+            return 0
+
+    async def monitor(self):
+        """Lấy mẫu độ trễ event loop và số FD đang mở trong suốt lần chạy"""
+        loop = asyncio.get_running_loop()
+        while True:
+            self.peak_fds = max(self.peak_fds, self.open_fds())
+            started = loop.time()
+            await asyncio.sleep(METRICS_INTERVAL)
+            lag = max(0.0, loop.time() - started - METRICS_INTERVAL)
+            self.loop_lag_max = max(self.loop_lag_max, lag)
+            self.loop_lag_total += lag
+            self.loop_lag_samples += 1
+
+    def report(self, summary: Dict[str, Any]) -> Dict[str, Any]:
+        checks = sum(self.latency_buckets)
+        buckets = {str(le): n for le, n in zip(self.LATENCY_BUCKETS_MS, self.latency_buckets)}
+        buckets['+Inf'] = self.latency_buckets[-1]
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if 'resource' in globals() else 0
+        return {
+            'started_at': self.started_at.isoformat(),
+            **summary,
+            'phases_s': {phase: round(seconds, 3) for phase, seconds in self.phases.items()},
+            'check_latency_ms': {
+                'buckets': buckets,
+                'count': checks,
+                'sum': round(self.latency_sum_ms),
+                'avg': round(self.latency_sum_ms / checks, 1) if checks else 0,
+            },
+            'protocols': self.protocols,
+            'failures': dict(sorted(self.failures.items(), key=lambda kv: -kv[1])),
+            'source_errors': self.source_errors,
+            'loop_lag_ms': {
+                'max': round(self.loop_lag_max * 1000, 1),
+                'avg': round(self.loop_lag_total / self.loop_lag_samples * 1000, 1) if self.loop_lag_samples else 0,
+            },
+            'peak_open_fds': self.peak_fds,
+            'peak_rss_mb': round(rss / 1024 / (1024 if sys.platform == 'darwin' else 1), 1),
+        }
+
+    @staticmethod
+    def prometheus(report: Dict[str, Any]) -> str:
+        """Dạng text exposition của Prometheus (cho textfile collector)"""
+        out = []
+
+        def metric(name: str, kind: str, help_text: str, samples: List[Tuple[str, Any]]):
+            out.append(f"# HELP proxy_fetcher_{name} {help_text}")
+            out.append(f"# TYPE proxy_fetcher_{name} {kind}")
+            out.extend(f"proxy_fetcher_{name}{labels} {value}" for labels, value in samples)
+
+        metric('duration_seconds', 'gauge', 'Tổng thời gian lần chạy', [('', report['duration_s'])])
+        metric('phase_seconds', 'gauge', 'Thời gian từng phase',
+               [(f'{{phase="{p}"}}', v) for p, v in report['phases_s'].items()])
+        metric('candidates', 'gauge', 'Số proxy thô', [('', report['candidates'])])
+        metric('live', 'gauge', 'Số proxy live sau lần kiểm tra đầu', [('', report['live'])])
+        metric('confirmed', 'gauge', 'Số proxy live sau lượt xác nhận', [('', report['confirmed'])])
+        cumulative = 0
+        samples = []
+        for le, count in report['check_latency_ms']['buckets'].items():
+            cumulative += count
+            samples.append((f'_bucket{{le="{le if le == "+Inf" else int(le) / 1000}"}}', cumulative))
+        samples.append(('_sum', report['check_latency_ms']['sum'] / 1000))
+        samples.append(('_count', cumulative))
+        metric('check_seconds', 'histogram', 'Thời gian 1 check', samples)
+        metric('checks_total', 'counter', 'Số check theo protocol và kết quả',
+               [(f'{{protocol="{p}",result="{r}"}}', n) for p, counts in report['protocols'].items()
+                for r, n in counts.items()])
+        metric('check_failures_total', 'counter', 'Số check thất bại theo lý do',
+               [(f'{{reason="{r}"}}', n) for r, n in report['failures'].items()])
+        metric('source_errors_total', 'counter', 'Số nguồn lỗi theo lý do',
+               [(f'{{reason="{r}"}}', n) for r, n in report['source_errors'].items()])
+        metric('loop_lag_seconds_max', 'gauge', 'Độ trễ event loop lớn nhất',
+               [('', report['loop_lag_ms']['max'] / 1000)])
+        metric('open_fds_peak', 'gauge', 'Số FD mở tối đa (lấy mẫu)', [('', report['peak_open_fds'])])
+        metric('rss_peak_megabytes', 'gauge', 'Peak RSS', [('', report['peak_rss_mb'])])
+        return '\n'.join(out) + '\n'
+
+    def write(self, summary: Dict[str, Any], path: str = REPORT_FILE, prometheus_path: Optional[str] = None):
+        report = self.report(summary)
+        prometheus_path = prometheus_path or PROMETHEUS_FILE
+        try:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            if prometheus_path:
+                os.makedirs(os.path.dirname(prometheus_path) or '.', exist_ok=True)
+                with open(prometheus_path, 'w', encoding='utf-8') as f:
+                    f.write(self.prometheus(report))
+        except OSError as e:
+            logger.error(f"Lỗi ghi báo cáo lần chạy: {e}")
+
+
+def dump_json(obj: Any) -> bytes:
+    """JSON gọn (không indent), UTF-8 — dùng orjson nếu có"""
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class ExportWriter:
+    """Ghi file export theo kiểu tăng dần.
+
+    Mỗi file được nhận diện bằng hash phần dữ liệu (không tính thời điểm build): hash không đổi
+    thì giữ nguyên file cũ. File trong api/ được ghi kèm bản nén .gz/.br; file không còn được xuất trong
+    các thư mục đã prune sẽ bị xoá.
+    """
+
+    def __init__(self, hashes_path: str = EXPORT_HASHES):
+        self.hashes_path = hashes_path
+        self.hashes: Dict[str, str] = {}
+        self.exported: Set[str] = set()
+        self.written = 0
+        self.unchanged = 0
+        self.removed = 0
+        self.bytes_written = 0
+        try:
+            with open(hashes_path, 'r', encoding='utf-8') as f:
+                self.hashes = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def write(self, path: str, body: bytes, render=None) -> bool:
+        """render(body) → nội dung đầy đủ của file (vd. thêm header thời gian); mặc định là body"""
+        self.exported.add(path)
+        # Chỉ nén file trong api/: proxies.txt / sub.txt ở gốc repo không cần bản nén đi kèm
+        compress = EXPORT_COMPRESS and path.startswith('api/')
+        digest = hashlib.sha256(body).hexdigest()
+        if self.hashes.get(path) == digest and os.path.exists(path):
+            if not compress:
+                self._remove(path + '.gz')
+                self._remove(path + '.br')
+            self.unchanged += 1
+            return False
+        content = render(body) if render else body
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._write_file(path, content)
+        if compress:
+            self._write_file(path + '.gz', gzip.compress(content, compresslevel=9, mtime=0))
+        else:
+            self._remove(path + '.gz')
+        if compress and brotli:
+            self._write_file(path + '.br', brotli.compress(content))
+        else:
+            self._remove(path + '.br')
+        self.hashes[path] = digest
+        self.written += 1
+        return True
+
+    def write_json(self, path: str, items: List[bytes], updated_at: str) -> bool:
+        """items: từng proxy đã serialize sẵn — mỗi proxy chỉ encode 1 lần cho mọi file chứa nó"""
+        header = b'{"updated_at":' + dump_json(updated_at) + b',"total":%d,"data":' % len(items)
+        return self.write(path, b'[' + b','.join(items) + b']', lambda body: header + body + b'}')
+
+    def prune(self, directory: str):
+        """Xoá file .json (và bản nén) trong thư mục không được xuất ở lần chạy này"""
+        if not os.path.isdir(directory):
+            return
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            base = path[:-3] if path.endswith(('.gz', '.br')) else path
+            if base.endswith('.json') and base not in self.exported:
+                self._remove(path)
+                if path == base:
+                    self.removed += 1
+
+    def save(self):
+        self.hashes = {path: digest for path, digest in self.hashes.items() if path in self.exported}
+        try:
+            with open(self.hashes_path, 'w', encoding='utf-8') as f:
+                json.dump(self.hashes, f, indent=0, sort_keys=True)
+        except OSError as e:
+            logger.error(f"Lỗi ghi '{self.hashes_path}': {e}")
+
+    def _write_file(self, path: str, content: bytes):
+        tmp = f"{path}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(content)
+        os.replace(tmp, path)
+        self.bytes_written += len(content)
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class ProxyIndex:
+    """Chỉ mục trên 1 snapshot pool live, proxy xếp theo score giảm dần.
+
+    Mỗi trường lọc (countryCode / asn / user_type / type) ánh xạ giá trị → danh sách vị trí tăng dần,
+    nên truy vấn chỉ duyệt danh sách ngắn nhất trong các chỉ mục được dùng và dừng khi đủ kết quả.
+    """
+    FIELDS = {'country': 'countryCode', 'asn': 'asn', 'user_type': 'user_type', 'type': 'type'}
+    LOWERCASE = ('user_type', 'type')              # chỉ mục theo chữ thường (mặc định 'Unknown' vẫn lọc được)
+
+    @classmethod
+    def value(cls, proxy: Dict[str, Any], name: str) -> Any:
+        value = proxy.get(cls.FIELDS[name])
+        return value.lower() if name in cls.LOWERCASE and isinstance(value, str) else value
+
+    def __init__(self, proxies: List[Dict[str, Any]]):
+        self.built_at = time.time()
+        self.proxies = sorted(proxies, key=lambda p: p['score'], reverse=True)
+        self.encoded: Dict[int, bytes] = {}         # serialize lười, mỗi proxy tối đa 1 lần
+        self.by: Dict[str, Dict[Any, List[int]]] = {name: {} for name in self.FIELDS}
+        for i, proxy in enumerate(self.proxies):
+            for name in self.FIELDS:
+                self.by[name].setdefault(self.value(proxy, name), []).append(i)
+
+    def positions(self, filters: Dict[str, List[Any]]) -> Optional[List[int]]:
+        """Danh sách vị trí ứng viên ngắn nhất theo các chỉ mục (None = không lọc theo chỉ mục)"""
+        best = None
+        for name, values in filters.items():
+            index = self.by[name]
+            if len(values) == 1:
+                candidates = index.get(values[0], [])
+            else:
+                candidates = sorted(i for v in values for i in index.get(v, []))
+            if best is None or len(candidates) < len(best):
+                best = candidates
+        return best
+
+    def query(self, filters: Dict[str, List[Any]], max_latency: Optional[float],
+              offset: int, limit: int, sample: bool) -> Tuple[List[int], bool]:
+        """Trả về (vị trí các proxy khớp, còn kết quả phía sau hay không)"""
+        candidates = self.positions(filters)
+        iterable = candidates if candidates is not None else range(len(self.proxies))
+        checks = [(name, set(values)) for name, values in filters.items()]
+
+        def matches():
+            for i in iterable:
+                proxy = self.proxies[i]
+                if max_latency is not None and proxy['latency_ms'] > max_latency:
+                    continue
+                if all(self.value(proxy, name) in values for name, values in checks):
+                    yield i
+
+        if sample:
+            found = list(matches())
+            return random.sample(found, min(limit, len(found))), False
+        result = []
+        for n, i in enumerate(matches()):
+            if n < offset:
+                continue
+            if len(result) == limit:
+                return result, True
+            result.append(i)
+        return result, False
+
+    def encode(self, i: int) -> bytes:
+        body = self.encoded.get(i)
+        if body is None:
+            body = self.encoded[i] = dump_json(self.proxies[i])
+        return body
+
+
+class ProxyFetcher:
+    def __init__(self, processes: int = VERIFY_PROCESSES):
+        self.processes = max(1, processes)
+        self.raw_proxies = CandidateStore()
+        self.live_proxies: Dict[int, Dict[str, Any]] = {}
+        self.failed_ips: Set[int] = set()        # endpoint (key int) không TCP connect được
+        self.failed_checks: Set[int] = set()     # check id (key, proto) đã kiểm tra và thất bại
         self.sources: List[str] = []
         self.working_sources: List[str] = []
         self.all_source_lines: List[str] = []
-        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.controller = ConcurrencyController()
+        self.metrics = RunMetrics()
         self.start_time: float = 0
         self.checked_count: int = 0
         self.total_checks: int = 0
+        self.skipped_checks: int = 0
+        self.health = HealthStore()
+        self.prior = CandidatePrior()
+        self.engine = CHECK_ENGINE
+        self.deadline: Optional[float] = None          # --budget: thời điểm phải export xong
+        self.targets = TargetPool(TEST_TARGETS)
+        self.source_cache = SourceCache()
+        self.source_stats = SourceStats()
+        self.unchanged_sources: int = 0
+        self.deferred: Set[int] = set()
+        self.check_queue: Optional[asyncio.PriorityQueue] = None
+        self.check_seq: int = 0
+        self.sources_done = asyncio.Event()
+        # Chế độ daemon (run_daemon)
+        self.budget: Optional[RateBudget] = None
+        self.pending: Set[int] = set()                  # key đang nằm trong hàng đợi kiểm tra
+        self.recheck_heap: Optional[List[Tuple[float, int]]] = None
+        self.recheck_due: Dict[int, float] = {}
+        self.streaks: Dict[int, int] = {}               # số lần live liên tiếp của proxy live
+        self.recheck_tasks: Set[asyncio.Future] = set()
+        self.sources_accounted_at = 0.0
+        self.index: Optional[ProxyIndex] = None        # chỉ mục cho API truy vấn (--api)
+        # Gateway (--gateway)
+        self.gateway_keys: List[int] = []
+        self.gateway_weights: List[float] = []         # trọng số cộng dồn theo score, chọn bằng bisect
+        self.gateway_built_at = 0.0
+        self.upstream_active: Dict[int, int] = {}
+        self.ejected: Dict[int, float] = {}            # key -> thời điểm hết bị loại
+        self.gateway_tasks: Set[asyncio.Task] = set()  # handler của các kết nối client đang mở
+        self.gateway_stats = {'connections': 0, 'tunnels': 0, 'failovers': 0, 'ejected': 0, 'failed': 0}
 
     # ----------------------------------------------------------------
     # SOURCE LOADING
@@ -89,49 +1572,169 @@ class ProxyFetcher:
                         sources.append(line_strip)
         return sources
 
-    async def fetch_url(self, session: aiohttp.ClientSession, url: str) -> Optional[tuple]:
+    async def fetch_and_parse(self, session: aiohttp.ClientSession, url: str) -> Optional[bool]:
+        """Tải nguồn theo chunk và parse ngay trong lúc tải (GET có điều kiện ETag / Last-Modified).
+        Nguồn không đổi (304 hoặc trùng hash) dùng lại danh sách đã parse lần trước.
+        Trả về True nếu nội dung mới, False nếu không đổi, None nếu lỗi."""
+        headers = {}
+        cached = self.source_cache.entries.get(url)
+        if cached:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+        now = time.time()
+        started = time.perf_counter()
+        nbytes = 0
+        parser = SourceParser(
+            self.url_protocols(url),
+            lambda key, ip, port, protocols, username, password:
+                self.add_candidate(ip, port, protocols, username, password, url, now)
+        )
         try:
             timeout = aiohttp.ClientTimeout(total=SOURCE_TIMEOUT)
-            async with session.get(url, timeout=timeout) as response:
-                if response.status == 200:
-                    return (url, await response.text())
-        except Exception:
-            pass
-        return (url, None)
+            async with session.get(url, timeout=timeout, headers=headers) as response:
+                if response.status == 304 and cached:
+                    self.source_stats.record_fetch(url, 0, time.perf_counter() - started)
+                    self.reuse_source(url, cached)
+                    return False
+                if response.status != 200:
+                    self.metrics.record_source_error(f"http_{response.status}")
+                    return None
+                # Có hash cũ nhưng server không hỗ trợ (hoặc bỏ qua) ETag/Last-Modified: tải hết rồi so hash
+                # trước khi parse, để proxy chết của nguồn không đổi được hoãn theo SKIP_UNCHANGED_DEAD
+                ignores_conditional = bool(cached and cached.get('ignores_conditional'))
+                buffer_first = bool(cached and (ignores_conditional
+                                                or not cached.get('etag') and not cached.get('last_modified')))
+                hasher = hashlib.sha256()
+                chunks: List[bytes] = []
+                async for chunk in response.content.iter_chunked(SOURCE_CHUNK_SIZE):
+                    nbytes += len(chunk)
+                    hasher.update(chunk)
+                    if buffer_first:
+                        chunks.append(chunk)
+                    else:
+                        with self.metrics.timed('parse'):
+                            parser.feed(chunk)
+                response_headers = response.headers.copy()
+        except Exception as e:
+            self.metrics.record_source_error(failure_reason(e, connect=True))
+            return None
+
+        self.source_stats.record_fetch(url, nbytes, time.perf_counter() - started)
+        digest = hasher.hexdigest()
+        changed = not (cached and cached.get('sha256') == digest)
+        if not changed:
+            # Đã gửi điều kiện mà vẫn nhận 200 với nội dung cũ → từ lần sau đi đường buffer_first
+            ignores_conditional = ignores_conditional or bool(headers)
+            if buffer_first:
+                self.source_cache.update(url, response_headers, digest, cached['parsed'], ignores_conditional)
+                self.reuse_source(url, cached)
+                return False
+            # Lần phát hiện đầu tiên: ứng viên đã vào hàng đợi như nguồn mới trong lúc tải
+            self.unchanged_sources += 1
+        with self.metrics.timed('parse'):
+            for chunk in chunks:
+                parser.feed(chunk)
+            parser.close()
+        self.source_cache.update(url, response_headers, digest, parser.result(), ignores_conditional)
+        if parser.protocols and url not in self.working_sources:
+            self.working_sources.append(url)
+        return changed
+
+    def reuse_source(self, url: str, cached: Dict[str, Any]):
+        now = time.time()
+        self.unchanged_sources += 1
+        self.source_stats.reused.add(url)
+        credentials = cached['parsed']['credentials']
+        for group, keys in cached['parsed']['groups'].items():
+            protocols = tuple(group.split(','))
+            for key in keys:
+                ip, _, port = key.rpartition(':')
+                username, password = credentials.get(key) or (None, None)
+                self.add_candidate(ip, port, protocols, username, password, url, now, fresh=False)
+        if cached['parsed']['groups'] and url not in self.working_sources:
+            self.working_sources.append(url)
 
-    def parse_proxy_list(self, content: str, url: str) -> bool:
-        if not content:
-            return False
-        url_lower = url.lower()
-        found = False
-        for match in PROXY_RE.finditer(content):
-            ip, port = match.group('ip'), match.group('port')
-            if not ip or not port:
-                continue
-            found = True
-            if match.group('protocol'):
-                protocols = [match.group('protocol').lower()]
-            else:
-                if 'socks5' in url_lower:
-                    protocols = ['socks5']
-                elif 'socks4' in url_lower:
-                    protocols = ['socks4']
-                elif 'http' in url_lower:
-                    protocols = ['http']
-                else:
-                    protocols = ['http', 'socks5', 'socks4']
-            key = f"{ip}:{port}"
-            if key not in self.raw_proxies:
-                self.raw_proxies[key] = {
-                    'ip': ip, 'port': port, 'protocols': protocols,
-                    'username': match.group('username'), 'password': match.group('password'),
-                    'country': 'Unknown', 'countryCode': '??', 'isp': 'Unknown', 'user_type': 'Unknown'
-                }
+    @staticmethod
+    def url_protocols(url: str) -> List[str]:
+        """Protocol mặc định cho dòng không ghi scheme, đoán từ URL nguồn"""
+        # Bỏ scheme: "http" trong "https://..." không phải là gợi ý protocol
+        url_lower = url.lower().split('://', 1)[-1]
+        if 'socks5' in url_lower:
+            return ['socks5']
+        if 'socks4' in url_lower:
+            return ['socks4']
+        if 'http' in url_lower:
+            return ['http']
+        return ['http', 'socks5', 'socks4']
+
+    def add_candidate(self, ip: str, port: str, protocols: Tuple[str, ...],
+                      username: Optional[str], password: Optional[str], url: str, now: float, fresh: bool = True):
+        ikey = pack_key(ip, port)
+        mask = proto_mask(protocols)
+        new = self.raw_proxies.add(ikey, mask, username, password)
+        if not new and self.budget is not None:
+            # DAEMON_DEAD_RETRY đã là ngưỡng thử lại, không hoãn thêm theo nguồn không đổi
+            retry = self.due_for_retry(ikey, mask, now)
+            if retry:
+                self.enqueue_check(ikey, retry, now, source=url)
+        if fresh and self.deferred:
+            # Proxy bị hoãn vì chỉ đến từ nguồn không đổi, nay xuất hiện ở nguồn mới → kiểm tra lại
+            for bit in MASK_BITS[mask & ~new]:
+                cid = ikey << 4 | bit
+                if cid in self.deferred:
+                    self.deferred.discard(cid)
+                    new |= bit
+        if new:
+            self.enqueue_check(ikey, new, now, fresh, url)
+        for bit in MASK_BITS[mask]:
+            self.health.seen(ikey << 4 | bit, url, now, ikey)
+
+    def due_for_retry(self, ikey: int, mask: int, now: float) -> int:
+        """Daemon: proxy đã biết và đã chết, nguồn vẫn liệt kê → thử lại khi hết backoff"""
+        if ikey in self.live_proxies or ikey in self.pending:
+            return 0
+        retry = 0
+        for bit in MASK_BITS[mask]:
+            cid = ikey << 4 | bit
+            if (cid in self.failed_checks and self.health.checked_ago(cid, now) >= DAEMON_DEAD_RETRY
+                    and self.health.should_check(cid, now)):
+                retry |= bit
+        if retry:
+            self.failed_ips.discard(ikey)
+            for bit in MASK_BITS[retry]:
+                self.failed_checks.discard(ikey << 4 | bit)
+        return retry
+
+    def enqueue_check(self, ikey: int, mask: int, now: float, fresh: bool = True, source: Optional[str] = None):
+        """Mỗi cặp (key, proto) chỉ được đưa vào hàng đợi đúng 1 lần (dedup theo raw_proxies).
+        Nhiều protocol cùng lúc (nguồn không rõ loại) được gộp thành 1 check dò protocol.
+
+        Thứ tự: proxy live gần đây trước, sau đó theo số lần fail, cùng số lần fail thì prior cao trước."""
+        if self.check_queue is None:
+            return
+        due = 0
+        for bit in MASK_BITS[mask]:
+            cid = ikey << 4 | bit
+            if not self.health.should_check(cid, now):
+                self.skipped_checks += 1
+            elif not fresh and SKIP_UNCHANGED_DEAD and self.health.failed_recently(cid, now):
+                # Nguồn không đổi và lần trước đã chết → hoãn
+                self.deferred.add(cid)
+                self.skipped_checks += 1
             else:
-                for proto in protocols:
-                    if proto not in self.raw_proxies[key]['protocols']:
-                        self.raw_proxies[key]['protocols'].append(proto)
-        return found
+                due |= bit
+        if not due:
+            return
+        self.check_seq += 1
+        self.total_checks += 1
+        priority = min(self.health.priority(ikey << 4 | bit) for bit in MASK_BITS[due])
+        if priority >= 0:
+            priority += 1 - self.prior.score(ikey, mask, source)
+        self.check_queue.put_nowait((priority, self.check_seq, ikey, due))
+        if self.budget is not None:
+            self.pending.add(ikey)
 
     # ----------------------------------------------------------------
     # IP VALIDATION
@@ -167,44 +1770,75 @@ class ProxyFetcher:
             return f"Proxy-Authorization: Basic {cred}\r\n"
         return ""
 
+    async def _open_connection(self, ip: str, port: str) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        started = time.perf_counter()
+        try:
+            conn = await asyncio.wait_for(asyncio.open_connection(ip, int(port)), timeout=CONNECT_TIMEOUT)
+        except Exception as e:
+            self.controller.record(e)
+            raise
+        self.controller.record(None, time.perf_counter() - started)
+        return conn
+
     @staticmethod
-    async def _check_http_proxy(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
-                                username: Optional[str], password: Optional[str]) -> bool:
-        """Gửi CONNECT request qua connection có sẵn"""
-        try:
-            auth = ProxyFetcher._build_auth_header(username, password)
-            req = (
-                f"CONNECT {TEST_URL}:443 HTTP/1.1\r\n"
-                f"Host: {TEST_URL}:443\r\n"
-                f"{auth}"
-                f"Connection: close\r\n"
-                f"\r\n"
-            )
-            writer.write(req.encode())
-            await asyncio.wait_for(writer.drain(), timeout=CHECK_TIMEOUT)
-            data = await asyncio.wait_for(reader.read(1024), timeout=CHECK_TIMEOUT)
-            return b" 200" in data
+    def _close_writer(writer: asyncio.StreamWriter):
+        try:
+            writer.close()
         except Exception:
-            return False
+            pass
 
     @staticmethod
-    async def _check_socks5_proxy(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
-                                  username: Optional[str], password: Optional[str]) -> bool:
-        """SOCKS5 handshake + CONNECT qua connection có sẵn"""
+    async def _http_connect(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, target: TestTarget,
+                            username: Optional[str], password: Optional[str]) -> bytes:
+        """Gửi CONNECT request qua connection có sẵn, trả về phản hồi thô (lỗi mạng được raise)"""
+        writer.write(target.http_request(ProxyFetcher._build_auth_header(username, password)))
+        await asyncio.wait_for(writer.drain(), timeout=CHECK_TIMEOUT)
+        return await asyncio.wait_for(reader.read(1024), timeout=CHECK_TIMEOUT)
+
+    @staticmethod
+    def _http_failure(data: bytes) -> Optional[str]:
+        if b" 200" in data:
+            return None
+        if not data:
+            return 'closed'
+        if data.startswith(b"HTTP/") and b" 407" in data[:16]:
+            return 'auth_rejected'
+        return 'bad_reply'
+
+    @staticmethod
+    async def _check_http_proxy(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, target: TestTarget,
+                                username: Optional[str], password: Optional[str]) -> Optional[str]:
         try:
-            # Greeting
-            if username and password:
-                writer.write(b'\x05\x02\x00\x02')
-            else:
-                writer.write(b'\x05\x01\x00')
-            await writer.drain()
+            data = await ProxyFetcher._http_connect(reader, writer, target, username, password)
+        except Exception as e:
+            return failure_reason(e)
+        return ProxyFetcher._http_failure(data)
 
-            data = await asyncio.wait_for(reader.read(2), timeout=CONNECT_TIMEOUT)
-            if len(data) < 2 or data[0] != 0x05:
-                return False
+    @staticmethod
+    async def _socks5_greeting(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                               username: Optional[str], password: Optional[str]) -> bytes:
+        """Gửi lời chào SOCKS5, trả về 2 byte chọn method (lỗi mạng được raise)"""
+        if username and password:
+            writer.write(b'\x05\x02\x00\x02')
+        else:
+            writer.write(b'\x05\x01\x00')
+        await writer.drain()
+        return await asyncio.wait_for(reader.read(2), timeout=CONNECT_TIMEOUT)
 
-            method = data[1]
+    @staticmethod
+    async def _socks5_finish(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, target: TestTarget,
+                             greeting: bytes, username: Optional[str], password: Optional[str]) -> Optional[str]:
+        """Auth (nếu cần) + CONNECT sau khi đã nhận phản hồi lời chào. None = live, ngược lại là lý do lỗi"""
+        try:
+            if not greeting:
+                return 'closed'
+            if len(greeting) < 2 or greeting[0] != 0x05:
+                return 'bad_reply'
+
+            method = greeting[1]
             if method == 0x02:
+                if not (username and password):
+                    return 'auth_rejected'
                 auth = (
                     b'\x01'
                     + bytes([len(username)]) + username.encode()
@@ -214,197 +1848,1016 @@ class ProxyFetcher:
                 await writer.drain()
                 auth_resp = await asyncio.wait_for(reader.read(2), timeout=CONNECT_TIMEOUT)
                 if len(auth_resp) < 2 or auth_resp[1] != 0x00:
-                    return False
+                    return 'auth_rejected' if auth_resp else 'closed'
             elif method == 0xFF:
-                return False
+                return 'auth_rejected'
 
-            # Connect to TEST_URL:443
-            domain = TEST_URL.encode()
-            writer.write(
-                b'\x05\x01\x00\x03'
-                + bytes([len(domain)]) + domain
-                + b'\x01\xBB'  # port 443
-            )
+            writer.write(target.socks5_connect)
             await writer.drain()
 
             resp = await asyncio.wait_for(reader.read(32), timeout=CHECK_TIMEOUT)
-            return len(resp) >= 2 and resp[1] == 0x00
-        except Exception:
-            return False
+            if len(resp) >= 2 and resp[1] == 0x00:
+                return None
+            return 'bad_reply' if resp else 'closed'
+        except Exception as e:
+            return failure_reason(e)
 
     @staticmethod
-    async def _check_socks4_proxy(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
-        """SOCKS4 CONNECT qua connection có sẵn"""
-        try:
-            dst_ip = socket.gethostbyname(TEST_URL)
-            writer.write(
-                b'\x04\x01'
-                + (443).to_bytes(2, 'big')
-                + socket.inet_aton(dst_ip)
-                + b'\x00'
-            )
+    async def _check_socks5_proxy(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, target: TestTarget,
+                                  username: Optional[str], password: Optional[str]) -> Optional[str]:
+        """SOCKS5 handshake + CONNECT qua connection có sẵn"""
+        try:
+            greeting = await ProxyFetcher._socks5_greeting(reader, writer, username, password)
+        except Exception as e:
+            return failure_reason(e)
+        return await ProxyFetcher._socks5_finish(reader, writer, target, greeting, username, password)
+
+    @staticmethod
+    async def _check_socks4_proxy(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                                  target: TestTarget) -> Optional[str]:
+        """SOCKS4 CONNECT qua connection có sẵn (IP đích đã resolve sẵn)"""
+        try:
+            writer.write(target.socks4_connect)
             await writer.drain()
 
             resp = await asyncio.wait_for(reader.read(8), timeout=CHECK_TIMEOUT)
-            return len(resp) >= 2 and resp[1] == 0x5A
+            if len(resp) >= 2 and resp[1] == 0x5A:
+                return None
+            return 'bad_reply' if resp else 'closed'
+        except Exception as e:
+            return failure_reason(e)
+
+    @staticmethod
+    async def _check_protocol(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, target: TestTarget,
+                              proto: str, username: Optional[str], password: Optional[str]) -> Optional[str]:
+        """None nếu proxy live với protocol này, ngược lại là lý do thất bại (xem failure_reason)"""
+        try:
+            if proto == 'socks5':
+                return await ProxyFetcher._check_socks5_proxy(reader, writer, target, username, password)
+            if proto == 'socks4':
+                return await ProxyFetcher._check_socks4_proxy(reader, writer, target)
+            return await ProxyFetcher._check_http_proxy(reader, writer, target, username, password)
+        except Exception as e:
+            return failure_reason(e)
+
+    # ----------------------------------------------------------------
+    # PROTOCOL CHECK / SNIFF
+    # ----------------------------------------------------------------
+    async def _measure_transfer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                                target: TestTarget) -> Optional[float]:
+        """TLS + GET nhỏ qua tunnel đã mở, trả về tốc độ tải (KB/s)"""
+        try:
+            started = time.perf_counter()
+            deadline = started + TRANSFER_TIMEOUT
+            await asyncio.wait_for(writer.start_tls(TRANSFER_SSL_CONTEXT, server_hostname=target.host),
+                                   timeout=TRANSFER_TIMEOUT)
+            writer.write(f"GET {TRANSFER_PATH} HTTP/1.1\r\nHost: {target.host}\r\nConnection: close\r\n\r\n".encode())
+            received = 0
+            while received < TRANSFER_MAX_BYTES:
+                chunk = await asyncio.wait_for(reader.read(16384), timeout=max(0.01, deadline - time.perf_counter()))
+                if not chunk:
+                    break
+                received += len(chunk)
+            elapsed = time.perf_counter() - started
+            return round(received / 1024 / elapsed, 1) if received and elapsed > 0 else None
         except Exception:
-            return False
+            return None
+
+    async def _check_single(self, ip: str, port: str, proto: str, user: Optional[str], pwd: Optional[str],
+                            measure_transfer: bool = False) -> CheckResult:
+        if self.engine == 'protocol' and not measure_transfer:
+            return await self._check_single_raw(ip, port, proto, user, pwd)
+        started = time.perf_counter()
+        try:
+            reader, writer = await self._open_connection(ip, port)
+        except Exception as e:
+            return CheckResult(None, [proto], False, failure=failure_reason(e, connect=True))
+        connected = time.perf_counter()
+        target = self.targets.next()
+        failure = await self._check_protocol(reader, writer, target, proto, user, pwd)
+        is_live = failure is None
+        result = CheckResult(proto if is_live else None, [proto], True,
+                             (connected - started) * 1000, (time.perf_counter() - connected) * 1000, failure)
+        if is_live and measure_transfer:
+            result.speed_kbps = await self._measure_transfer(reader, writer, target)
+        self._close_writer(writer)
+        self.targets.report(target, is_live)
+        return result
+
+    async def _sniff_protocol(self, ip: str, port: str, candidates: List[str],
+                              user: Optional[str], pwd: Optional[str]) -> CheckResult:
+        """Dò HTTP / SOCKS5 / SOCKS4 với tối đa 1 connection cho mỗi protocol khả dĩ.
+
+        Proxy HTTP trả lời "HTTP/..." ngay trên connection đầu tiên; proxy SOCKS đóng kết nối
+        hoặc trả về byte nhị phân, khi đó mới mở connection tiếp theo để thử SOCKS5 rồi SOCKS4.
+        """
+        if self.engine == 'protocol':
+            return await self._sniff_protocol_raw(ip, port, candidates, user, pwd)
+        tried: List[str] = []
+        reachable = False
+        failure = None
+        target = self.targets.next()
+        http_proto = next((p for p in candidates if p in ('http', 'https')), None)
+        socks_protos = [p for p in ('socks5', 'socks4') if p in candidates]
+
+        if http_proto:
+            started = time.perf_counter()
+            try:
+                reader, writer = await self._open_connection(ip, port)
+            except Exception as e:
+                return CheckResult(None, list(candidates), False, failure=failure_reason(e, connect=True))
+            connected = time.perf_counter()
+            reachable = True
+            try:
+                data = await self._http_connect(reader, writer, target, user, pwd)
+            except Exception as e:
+                data = b""
+                failure = failure_reason(e)
+            self._close_writer(writer)
+            if data.startswith(b"HTTP/"):
+                # Endpoint nói HTTP — không cần thử SOCKS nữa
+                failure = self._http_failure(data)
+                is_live = failure is None
+                self.targets.report(target, is_live)
+                return CheckResult(http_proto if is_live else None, list(candidates), True,
+                                   (connected - started) * 1000, (time.perf_counter() - connected) * 1000, failure)
+            if data:
+                failure = 'bad_reply'
+            tried.extend(p for p in candidates if p in ('http', 'https'))
+
+        for i, proto in enumerate(socks_protos):
+            started = time.perf_counter()
+            try:
+                reader, writer = await self._open_connection(ip, port)
+            except Exception as e:
+                return CheckResult(None, tried + socks_protos[i:], reachable,
+                                   failure=failure_reason(e, connect=True))
+            connected = time.perf_counter()
+            reachable = True
+            answered = False
+            proto_failure = None
+            if proto == 'socks5':
+                try:
+                    greeting = await self._socks5_greeting(reader, writer, user, pwd)
+                except Exception as e:
+                    greeting = b""
+                    failure = failure_reason(e)
+                if greeting[:1] == b'\x05':
+                    answered = True
+                    proto_failure = await self._socks5_finish(reader, writer, target, greeting, user, pwd)
+                    tried.extend(socks_protos[i:])
+                elif greeting:
+                    failure = 'bad_reply'
+            else:
+                answered = True
+                proto_failure = await self._check_socks4_proxy(reader, writer, target)
+                tried.append(proto)
+            self._close_writer(writer)
+            if answered:
+                is_live = proto_failure is None
+                self.targets.report(target, is_live)
+                return CheckResult(proto if is_live else None, tried, True,
+                                   (connected - started) * 1000, (time.perf_counter() - connected) * 1000,
+                                   proto_failure)
+            tried.append(proto)
+
+        return CheckResult(None, tried, reachable, failure=failure or 'bad_reply')
 
     # ----------------------------------------------------------------
-    # VERIFY TASK — 1 connection: TCP connect + protocol check
+    # ENGINE 'protocol' — loop.create_connection + HandshakeProtocol, 1 deadline cho mỗi check
     # ----------------------------------------------------------------
-    async def verify_task(self, proxy_data: Dict[str, Any], proto: str):
-        ip, port = proxy_data['ip'], proxy_data['port']
-        key = f"{ip}:{port}"
+    async def _probe(self, ip: str, port: str, proto: str, target: TestTarget, user: Optional[str],
+                     pwd: Optional[str]) -> Tuple[bool, float, float, bool, Optional[str]]:
+        """1 connection, 1 protocol. Trả về (connect được, connect_ms, handshake_ms, trả lời đúng kiểu, lý do lỗi).
+        Deadline duy nhất: CONNECT_TIMEOUT cho connect, dời thêm CHECK_TIMEOUT khi connect xong."""
+        loop = asyncio.get_running_loop()
+        protocol = HandshakeProtocol(proto, target, user, pwd, loop.create_future())
+        started = time.perf_counter()
+        connected = 0.0
+        try:
+            async with asyncio.timeout(CONNECT_TIMEOUT) as deadline:
+                await loop.create_connection(lambda: protocol, ip, int(port))
+                connected = time.perf_counter()
+                self.controller.record(None, connected - started)
+                deadline.reschedule(loop.time() + CHECK_TIMEOUT)
+                failure = await protocol.done
+        except Exception as e:
+            if not connected:
+                self.controller.record(e)
+                return False, 0.0, 0.0, False, failure_reason(e, connect=True)
+            failure = failure_reason(e)
+        finally:
+            protocol.abort()
+        return (True, (connected - started) * 1000, (time.perf_counter() - connected) * 1000,
+                protocol.answered, failure)
+
+    async def _check_single_raw(self, ip: str, port: str, proto: str, user: Optional[str],
+                                pwd: Optional[str]) -> CheckResult:
+        target = self.targets.next()
+        reachable, connect_ms, handshake_ms, _, failure = await self._probe(ip, port, proto, target, user, pwd)
+        if not reachable:
+            return CheckResult(None, [proto], False, failure=failure)
+        is_live = failure is None
+        self.targets.report(target, is_live)
+        return CheckResult(proto if is_live else None, [proto], True, connect_ms, handshake_ms, failure)
+
+    async def _sniff_protocol_raw(self, ip: str, port: str, candidates: List[str],
+                                  user: Optional[str], pwd: Optional[str]) -> CheckResult:
+        """Cùng thứ tự dò và cùng kết quả với _sniff_protocol, trên engine 'protocol'"""
+        tried: List[str] = []
+        reachable = False
+        failure = None
+        target = self.targets.next()
+        http_proto = next((p for p in candidates if p in ('http', 'https')), None)
+        socks_protos = [p for p in ('socks5', 'socks4') if p in candidates]
+
+        for proto in ([http_proto] if http_proto else []) + socks_protos:
+            connected, connect_ms, handshake_ms, answered, proto_failure = await self._probe(
+                ip, port, proto, target, user, pwd)
+            if not connected:
+                return CheckResult(None, tried + [p for p in candidates if p not in tried], reachable,
+                                   failure=proto_failure)
+            reachable = True
+            if proto == http_proto:
+                tried.extend(p for p in candidates if p in ('http', 'https'))
+            elif proto == 'socks5':
+                # Endpoint nói SOCKS5 thì không cần thử SOCKS4 nữa
+                tried.extend(socks_protos[socks_protos.index(proto):] if answered else [proto])
+            else:
+                tried.append(proto)
+            if answered:
+                is_live = proto_failure is None
+                self.targets.report(target, is_live)
+                return CheckResult(proto if is_live else None, tried, True, connect_ms, handshake_ms, proto_failure)
+            failure = proto_failure
 
-        if key in self.failed_ips:
-            return
+        return CheckResult(None, tried, reachable, failure=failure or 'bad_reply')
 
-        if self._is_private_ip(ip):
-            self.failed_ips.add(key)
+    # ----------------------------------------------------------------
+    # VERIFY TASK — 1 connection per plausible protocol
+    # ----------------------------------------------------------------
+    def _drop_check(self):
+        """Check đã xếp hàng nhưng không cần chạy nữa: không tính vào tổng, để checked == total khi chạy hết"""
+        self.total_checks -= 1
+        self.skipped_checks += 1
+
+    async def verify_task(self, ikey: int, mask: int):
+        if ikey in self.failed_ips or ikey in self.live_proxies:
+            self._drop_check()
             return
 
-        user, pwd = proxy_data['username'], proxy_data['password']
-
-        async with self.semaphore:
-            # 1 TCP connection: connect + protocol check (no separate pre-check)
-            try:
-                reader, writer = await asyncio.wait_for(
-                    asyncio.open_connection(ip, int(port)),
-                    timeout=CONNECT_TIMEOUT
-                )
-            except Exception:
-                self.failed_ips.add(key)
-                self.checked_count += 1
-                return
+        ip, port = unpack_key(ikey)
+        if not ALLOW_PRIVATE_IPS and self._is_private_ip(ip):
+            self.failed_ips.add(ikey)
+            self._drop_check()
+            return
 
-            # Protocol check trên connection có sẵn
-            is_live = False
-            try:
-                if proto == 'socks5':
-                    is_live = await self._check_socks5_proxy(reader, writer, user, pwd)
-                elif proto == 'socks4':
-                    is_live = await self._check_socks4_proxy(reader, writer)
-                else:
-                    is_live = await self._check_http_proxy(reader, writer, user, pwd)
-            except Exception:
-                pass
+        candidates = [BIT_PROTOS[bit] for bit in MASK_BITS[mask] if (ikey << 4 | bit) not in self.failed_checks]
+        if not candidates:
+            self._drop_check()
+            return
 
-            try:
-                writer.close()
-            except Exception:
-                pass
+        user, pwd = self.raw_proxies.auth(ikey)
+
+        started = time.perf_counter()
+        if len(candidates) == 1:
+            result = await self._check_single(ip, port, candidates[0], user, pwd)
+        else:
+            result = await self._sniff_protocol(ip, port, candidates, user, pwd)
+        self.metrics.record_check(result, time.perf_counter() - started)
+
+        self.checked_count += 1
+        now = time.time()
+        if not result.reachable:
+            # Không TCP connect được → mọi protocol của endpoint này đều chết
+            self.failed_ips.add(ikey)
+        for proto in result.tried:
+            cid = ikey << 4 | PROTO_BITS[proto]
+            self.health.record(cid, proto == result.proto, now)
+            if proto != result.proto:
+                self.failed_checks.add(cid)
+
+        if result.proto and ikey not in self.live_proxies:
+            # Chỉ proxy live mới được dựng thành dict đầy đủ
+            res = self.raw_proxies.materialize(ikey)
+            res['type'] = result.proto
+            res['connect_ms'] = [round(result.connect_ms)]
+            res['handshake_ms'] = [round(result.handshake_ms)]
+            res['checked_at'] = int(now)
+            self.live_proxies[ikey] = res
+            if self.recheck_heap is not None:
+                self.schedule_recheck(ikey, 1, now)
+
+        if self.checked_count % 5000 == 0:
+            elapsed = time.time() - self.start_time
+            rate = self.checked_count / elapsed if elapsed > 0 else 0
+            remaining = self.total_checks - self.checked_count
+            eta = remaining / rate if rate > 0 else 0
+            logger.info(
+                f"📊 Checked: {self.checked_count}/{self.total_checks} | "
+                f"Live: {len(self.live_proxies)} | "
+                f"Failed IPs: {len(self.failed_ips)} | "
+                f"Failed checks: {len(self.failed_checks)} | "
+                f"Concurrency: {self.controller.limit} | "
+                f"Speed: {rate:.0f}/s | ETA: {eta:.0f}s"
+            )
 
-            self.checked_count += 1
+    async def verify_worker(self):
+        """Worker sống suốt phase kiểm tra, lấy (key, protocol mask) từ hàng đợi cho tới khi gặp sentinel"""
+        while True:
+            priority, _, ikey, mask = await self.check_queue.get()
+            if ikey is None:
+                return
+            if self.budget is not None:
+                self.pending.discard(ikey)
+                await self.budget.acquire((1, priority))
+            async with self.controller:
+                await self.verify_task(ikey, mask)
+
+    async def run_verify_workers(self, count: int):
+        """Chạy `count` worker cho tới khi hàng đợi cạn (sentinel được thêm sau cùng)"""
+        workers = [asyncio.ensure_future(self.verify_worker()) for _ in range(count)]
+        await self.sources_done.wait()
+        for i in range(count):
+            self.check_queue.put_nowait((float('inf'), i, None, None))
+        await asyncio.gather(*workers)
 
-            if is_live:
-                if key not in self.live_proxies:
-                    res = proxy_data.copy()
-                    res['type'] = proto
-                    self.live_proxies[key] = res
-            else:
-                self.failed_ips.add(key)
+    # ----------------------------------------------------------------
+    # SHARDED VERIFY — 1 event loop / process
+    # ----------------------------------------------------------------
+    async def verify_shard(self, items: List[Tuple[float, int, int, int, Optional[Tuple[str, str]]]], concurrency: int,
+                           deadline: Optional[float] = None, engine: str = CHECK_ENGINE):
+        """Chạy trong process con: kiểm tra 1 shard và trả kết quả về process chính"""
+        self.start_time = time.time()
+        self.engine = engine
+        self.health.journal = []
+        await self.targets.resolve()
+        self.check_queue = asyncio.PriorityQueue()
+        self.sources_done.set()
+        for seq, (prio, ikey, due, mask, auth) in enumerate(items):
+            self.raw_proxies.masks[ikey] = mask
+            if auth:
+                self.raw_proxies.credentials[ikey] = auth
+            self.check_queue.put_nowait((prio, seq, ikey, due))
+        self.total_checks = len(items)
+        # ... và không vượt quá số file descriptor của chính process con
+        try:
+            concurrency = min(concurrency, resource.getrlimit(resource.RLIMIT_NOFILE)[0] - 256)
+        except Exception:
+            pass
+        self.controller = ConcurrencyController(max(CONCURRENCY_MIN, concurrency))
+        adapting = asyncio.ensure_future(self.controller.run())
+        monitoring = asyncio.ensure_future(self.metrics.monitor())
+        await self.wait_until([self.run_verify_workers(max(1, min(concurrency, len(items))))], deadline)
+        adapting.cancel()
+        monitoring.cancel()
+        return (self.live_proxies, self.failed_ips, self.failed_checks, self.health.journal,
+                self.checked_count, self.skipped_checks, self.metrics)
+
+    async def verify_sharded(self, deadline: Optional[float] = None):
+        """Chia theo key để mọi protocol của 1 proxy nằm cùng shard, rồi gộp kết quả"""
+        shards: List[List[Tuple[float, int, int, int, Optional[Tuple[str, str]]]]] = [[] for _ in range(self.processes)]
+        while not self.check_queue.empty():
+            prio, _, ikey, due = self.check_queue.get_nowait()
+            # hash(tuple) để trộn bit: key int lấy modulo trực tiếp sẽ chia theo port (phần lớn là số chẵn)
+            shards[hash((ikey,)) % self.processes].append(
+                (prio, ikey, due, self.raw_proxies.masks[ikey], self.raw_proxies.credentials.get(ikey))
+            )
 
-            if self.checked_count % 5000 == 0:
-                elapsed = time.time() - self.start_time
-                rate = self.checked_count / elapsed if elapsed > 0 else 0
-                remaining = self.total_checks - self.checked_count
-                eta = remaining / rate if rate > 0 else 0
-                logger.info(
-                    f"📊 Checked: {self.checked_count}/{self.total_checks} | "
-                    f"Live: {len(self.live_proxies)} | "
-                    f"Failed IPs: {len(self.failed_ips)} | "
-                    f"Speed: {rate:.0f}/s | ETA: {eta:.0f}s"
-                )
+        # Mỗi shard có ngân sách concurrency riêng (phần chia đều của MAX_CONCURRENT)
+        concurrency = max(1, MAX_CONCURRENT // self.processes)
+        logger.info(f"🧩 Chia {self.total_checks} checks cho {self.processes} process ({concurrency} concurrent/process)")
+
+        loop = asyncio.get_running_loop()
+        with ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context('spawn')) as pool:
+            futures = [loop.run_in_executor(pool, _verify_shard, shard, concurrency, deadline, self.engine)
+                       for shard in shards if shard]
+            for live, failed, failed_checks, journal, checked, dropped, metrics in await asyncio.gather(*futures):
+                self.metrics.merge(metrics)
+                self.live_proxies.update(live)
+                self.failed_ips |= failed
+                self.failed_checks |= failed_checks
+                self.checked_count += checked
+                self.total_checks -= dropped
+                self.skipped_checks += dropped
+                for entry in journal:
+                    self.health.record(*entry)
 
     # ----------------------------------------------------------------
     # CONFIRMATION — re-check live proxies to filter unstable ones
     # ----------------------------------------------------------------
     async def confirm_task(self, proxy_data: Dict[str, Any]):
         ip, port = proxy_data['ip'], proxy_data['port']
-        key = f"{ip}:{port}"
+        ikey = pack_key(ip, port)
         proto = proxy_data.get('type', 'http')
         user, pwd = proxy_data.get('username'), proxy_data.get('password')
 
-        async with self.semaphore:
-            try:
-                reader, writer = await asyncio.wait_for(
-                    asyncio.open_connection(ip, int(port)),
-                    timeout=CONNECT_TIMEOUT
-                )
-            except Exception:
-                self.failed_ips.add(key)
-                self.live_proxies.pop(key, None)
+        async with self.controller:
+            started = time.perf_counter()
+            result = await self._check_single(ip, port, proto, user, pwd, measure_transfer=MEASURE_TRANSFER)
+            self.metrics.record_check(result, time.perf_counter() - started)
+            if not result.proto:
+                if not result.reachable:
+                    self.failed_ips.add(ikey)
+                cid = ikey << 4 | PROTO_BITS[proto]
+                self.failed_checks.add(cid)
+                self.live_proxies.pop(ikey, None)
+                self.health.record(cid, False, time.time())
                 return
+            # Mẫu đo thứ 2
+            proxy_data['connect_ms'].append(round(result.connect_ms))
+            proxy_data['handshake_ms'].append(round(result.handshake_ms))
+            proxy_data['checked_at'] = int(time.time())
+            if result.speed_kbps is not None:
+                proxy_data['speed_kbps'] = result.speed_kbps
 
-            is_live = False
-            try:
-                if proto == 'socks5':
-                    is_live = await self._check_socks5_proxy(reader, writer, user, pwd)
-                elif proto == 'socks4':
-                    is_live = await self._check_socks4_proxy(reader, writer)
-                else:
-                    is_live = await self._check_http_proxy(reader, writer, user, pwd)
-            except Exception:
-                pass
+    @staticmethod
+    def score_proxy(proxy: Dict[str, Any]):
+        """Gộp các mẫu đo thành latency_ms trung bình và score 0-100 (càng nhanh càng cao)"""
+        samples = [c + h for c, h in zip(proxy.get('connect_ms', []), proxy.get('handshake_ms', []))]
+        latency = sum(samples) / len(samples) if samples else CONNECT_TIMEOUT * 1000 + CHECK_TIMEOUT * 1000
+        proxy['latency_ms'] = round(latency)
+        proxy['score'] = round(100 * LATENCY_REF_MS / (LATENCY_REF_MS + latency), 1)
 
+    # ----------------------------------------------------------------
+    # DAEMON — pool live trong bộ nhớ, kiểm tra lại theo lịch với tốc độ cố định
+    # ----------------------------------------------------------------
+    @staticmethod
+    def recheck_interval(streak: int) -> float:
+        """Proxy mới live được kiểm tra lại sớm, proxy ổn định lâu thì thưa dần"""
+        return min(DAEMON_RECHECK_MAX, DAEMON_RECHECK_MIN * 2 ** max(0, min(streak - 1, 16)))
+
+    def schedule_recheck(self, ikey: int, streak: int, now: float):
+        self.streaks[ikey] = streak
+        due = now + self.recheck_interval(streak)
+        self.recheck_due[ikey] = due
+        heapq.heappush(self.recheck_heap, (due, ikey))
+
+    def confirmed_proxies(self) -> List[Dict[str, Any]]:
+        """Chỉ xuất proxy đã live ít nhất 2 lần liên tiếp (tương đương lượt xác nhận của chế độ batch)"""
+        return [p for ikey, p in self.live_proxies.items() if self.streaks.get(ikey, 0) >= 2]
+
+    async def recheck_task(self, ikey: int):
+        proxy = self.live_proxies.get(ikey)
+        if proxy is None:
+            return
+        proto = proxy['type']
+        async with self.controller:
+            started = time.perf_counter()
+            result = await self._check_single(proxy['ip'], proxy['port'], proto,
+                                              proxy.get('username'), proxy.get('password'))
+            self.metrics.record_check(result, time.perf_counter() - started)
+        now = time.time()
+        cid = ikey << 4 | PROTO_BITS[proto]
+        self.health.record(cid, bool(result.proto), now)
+        streak = self.streaks.get(ikey, 0)
+        if result.proto:
+            for field, value in (('connect_ms', result.connect_ms), ('handshake_ms', result.handshake_ms)):
+                samples = proxy.setdefault(field, [])
+                samples.append(round(value))
+                del samples[:-LATENCY_SAMPLES]
+            proxy['checked_at'] = int(now)
+            self.ejected.pop(ikey, None)
+            self.schedule_recheck(ikey, streak + 1, now)
+        elif streak >= 2:
+            # Proxy đã ổn định: lỡ 1 lần thì ẩn khỏi export và thử lại sớm, chưa loại ngay
+            self.schedule_recheck(ikey, 0, now)
+        else:
+            if not result.reachable:
+                self.failed_ips.add(ikey)
+            self.failed_checks.add(cid)
+            self.live_proxies.pop(ikey, None)
+            self.streaks.pop(ikey, None)
+            self.recheck_due.pop(ikey, None)
+
+    async def recheck_loop(self):
+        """Lấy proxy tới hạn từ heap (sớm nhất trước), mỗi check tốn 1 token của budget.
+        Kiểm tra lại được phát token trước mọi proxy mới đang chờ, để pool live luôn tươi kể cả khi tồn đọng"""
+        while True:
+            now = time.time()
+            while self.recheck_heap and self.recheck_heap[0][0] <= now:
+                due, ikey = heapq.heappop(self.recheck_heap)
+                if self.recheck_due.get(ikey) != due:
+                    continue        # mục cũ, proxy đã được xếp lịch lại hoặc đã bị loại
+                await self.budget.acquire((0, due))
+                task = asyncio.ensure_future(self.recheck_task(ikey))
+                self.recheck_tasks.add(task)
+                task.add_done_callback(self.recheck_tasks.discard)
+                now = time.time()
+            delay = self.recheck_heap[0][0] - now if self.recheck_heap else 1.0
+            await asyncio.sleep(min(1.0, max(0.05, delay)))
+
+    async def source_loop(self, session: aiohttp.ClientSession):
+        """Mỗi nguồn có chu kỳ riêng: nội dung mới → về chu kỳ gốc, không đổi hoặc lỗi → giãn gấp đôi"""
+        intervals = {url: DAEMON_SOURCE_INTERVAL for url in self.sources}
+        next_fetch = {url: 0.0 for url in self.sources}
+        while True:
+            now = time.time()
+            due = [url for url, at in next_fetch.items() if at <= now]
+            if due:
+                with self.metrics.timed('fetch'):
+                    results = await asyncio.gather(*[self.fetch_and_parse(session, url) for url in due])
+                for url, changed in zip(due, results):
+                    if changed:
+                        intervals[url] = DAEMON_SOURCE_INTERVAL
+                    else:
+                        intervals[url] = min(DAEMON_SOURCE_INTERVAL_MAX, intervals[url] * 2)
+                    next_fetch[url] = now + intervals[url]
+                self.source_cache.save(self.sources)
+                logger.info(
+                    f"🔄 Tải lại {len(due)} nguồn: {len(self.raw_proxies)} proxy thô, "
+                    f"{self.check_queue.qsize()} chờ kiểm tra, {len(self.live_proxies)} live"
+                )
+            await asyncio.sleep(max(1.0, min(next_fetch.values(), default=now + 60) - time.time()))
+
+    async def flush_snapshot(self):
+        proxies = self.confirmed_proxies()
+        enriching = self.start_enrichment(proxies) if proxies else None
+        if enriching:
+            await enriching
+        with self.metrics.timed('export'):
+            self.export_all_formats(proxies)
+        await self.health.save_async()
+        now = time.time()
+        if now - self.sources_accounted_at >= DAEMON_SOURCE_ACCOUNT_INTERVAL:
+            # Các lượt tải trong cả khoảng được gộp thành 1 lần chạy, để SOURCE_MIN_RUNS / SOURCE_DIE_DRY_RUNS
+            # (đếm theo lần chạy cron) có cùng ý nghĩa ở chế độ daemon
+            self.account_sources(proxies, self.sources_accounted_at)
+            self.sources_accounted_at = now
+        self.evict_stale(now)
+        self.write_report(len(self.live_proxies))
+
+    def evict_stale(self, now: float):
+        """Danh sách free thay đổi liên tục: proxy không nguồn nào liệt kê trong DAEMON_EVICT_AFTER giây
+        (trừ proxy đang live / đang chờ kiểm tra) bị bỏ khỏi bộ nhớ cùng bản ghi health và trạng thái lỗi"""
+        stale = [ikey for ikey in self.health.stale_keys(now - DAEMON_EVICT_AFTER)
+                 if ikey not in self.live_proxies and ikey not in self.pending]
+        if not stale:
+            return
+        for ikey in stale:
+            self.raw_proxies.remove(ikey)
+            self.failed_ips.discard(ikey)
+            self.ejected.pop(ikey, None)
+            for bit in MASK_BITS[15]:
+                self.failed_checks.discard(ikey << 4 | bit)
+                self.deferred.discard(ikey << 4 | bit)
+        self.health.forget(stale)
+        logger.info(f"🧹 Bỏ {len(stale)} proxy không còn nguồn nào liệt kê, còn {len(self.raw_proxies)} proxy thô")
+
+    async def export_loop(self):
+        while True:
+            await asyncio.sleep(DAEMON_EXPORT_INTERVAL)
+            await self.flush_snapshot()
+
+    async def run_daemon(self):
+        """Chạy liên tục: nguồn tải lại theo chu kỳ riêng, proxy mới và proxy live được kiểm tra
+        với tốc độ DAEMON_CHECK_RATE, snapshot được xuất mỗi DAEMON_EXPORT_INTERVAL giây"""
+        self.start_time = time.time()
+        self.sources_accounted_at = self.start_time
+        self.sources = self.load_sources()
+        self.health.load()
+        self.source_stats.load()
+        self.prior.build(self.health, self.start_time, self.source_stats)
+        self.source_cache.load()
+        await self.targets.resolve()
+        self.check_queue = asyncio.PriorityQueue()
+        self.recheck_heap = []
+        self.budget = RateBudget(DAEMON_CHECK_RATE)
+
+        main_task = asyncio.current_task()
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, main_task.cancel)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+        connector = aiohttp.TCPConnector(limit=100, ttl_dns_cache=600, enable_cleanup_closed=True)
+        logger.info(
+            f"🛰️ Daemon: {len(self.sources)} nguồn, {DAEMON_CHECK_RATE} check/s, "
+            f"xuất snapshot mỗi {DAEMON_EXPORT_INTERVAL}s"
+        )
+        api = await self.start_api(API_HOST, API_PORT) if API_PORT else None
+        gateway = await self.start_gateway(GATEWAY_HOST, GATEWAY_PORT) if GATEWAY_PORT else None
+        async with aiohttp.ClientSession(connector=connector) as session:
+            tasks = [asyncio.ensure_future(coro) for coro in (
+                self.targets.refresher(),
+                self.controller.run(),
+                self.metrics.monitor(),
+                self.run_verify_workers(DAEMON_WORKERS),
+                self.recheck_loop(),
+                self.export_loop(),
+                self.source_loop(session),
+            )]
             try:
-                writer.close()
-            except Exception:
-                pass
+                await asyncio.gather(*tasks)
+            except asyncio.CancelledError:
+                logger.info("🛑 Dừng daemon, xuất snapshot cuối...")
+                raise
+            finally:
+                running = tasks + list(self.recheck_tasks)
+                for task in running:
+                    task.cancel()
+                await asyncio.gather(*running, return_exceptions=True)
+                if gateway:
+                    await self.stop_gateway(gateway)
+                self.export_all_formats(self.confirmed_proxies())
+                self.health.save()
+                self.source_cache.save(self.sources)
+                if api:
+                    await api.cleanup()
 
-            if not is_live:
-                self.failed_ips.add(key)
-                self.live_proxies.pop(key, None)
+    # ----------------------------------------------------------------
+    # QUERY API — phục vụ pool live của daemon trực tiếp từ bộ nhớ
+    # ----------------------------------------------------------------
+    def proxy_index(self) -> ProxyIndex:
+        """Snapshot + chỉ mục của pool đã xác nhận, dựng lại tối đa 1 lần mỗi API_INDEX_TTL giây"""
+        if self.index is None or time.time() - self.index.built_at >= API_INDEX_TTL:
+            proxies = []
+            for p in self.confirmed_proxies():
+                self.score_proxy(p)
+                proxies.append(dict(p))
+            self.index = ProxyIndex(proxies)
+        return self.index
+
+    @staticmethod
+    def _api_error(message: str) -> web.Response:
+        return web.Response(status=400, body=dump_json({'error': message}), content_type='application/json')
+
+    @staticmethod
+    def _api_response(request: web.Request, body: bytes, content_type: str, cacheable: bool = True) -> web.Response:
+        """ETag theo nội dung (không kèm thời điểm dựng chỉ mục): If-None-Match trùng → 304 không có body"""
+        etag = '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache' if cacheable else 'no-store'}
+        if cacheable and etag in request.headers.get('If-None-Match', ''):
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=body, content_type=content_type, headers=headers)
+
+    async def api_proxies(self, request: web.Request) -> web.Response:
+        """GET /proxies?country=DE,FR&type=socks5&user_type=residential&asn=123&max_latency=500
+        &limit=100&offset=0&random=1&format=json|txt"""
+        query = request.query
+        filters: Dict[str, List[Any]] = {}
+        try:
+            for name in ProxyIndex.FIELDS:
+                if query.get(name):
+                    values = [v.strip() for v in query[name].split(',') if v.strip()]
+                    if name == 'asn':
+                        values = [int(v) for v in values]
+                    elif name == 'country':
+                        values = [v.upper() for v in values]
+                    elif name in ('type', 'user_type'):
+                        values = [v.lower() for v in values]
+                    filters[name] = values
+            max_latency = float(query['max_latency']) if query.get('max_latency') else None
+            limit = int(query.get('limit', API_DEFAULT_LIMIT))
+            offset = int(query.get('offset', 0))
+        except ValueError as e:
+            return self._api_error(f"tham số không hợp lệ: {e}")
+        if not 0 < limit <= API_MAX_LIMIT or offset < 0:
+            return self._api_error(f"limit phải trong 1..{API_MAX_LIMIT}, offset >= 0")
+        sample = query.get('random', '') not in ('', '0', 'false')
+
+        index = self.proxy_index()
+        found, more = index.query(filters, max_latency, offset, limit, sample)
+        if query.get('format') == 'txt':
+            lines = []
+            for i in found:
+                p = index.proxies[i]
+                auth = f"{p['username']}:{p['password']}@" if p.get('username') else ""
+                lines.append(f"{p['type']}://{auth}{p['ip']}:{p['port']}\n")
+            return self._api_response(request, ''.join(lines).encode('utf-8'), 'text/plain', not sample)
+
+        meta = {'count': len(found), 'offset': offset,
+                'next_offset': offset + len(found) if more else None}
+        body = dump_json(meta)[:-1] + b',"data":[' + b','.join(index.encode(i) for i in found) + b']}'
+        return self._api_response(request, body, 'application/json', not sample)
+
+    async def api_stats(self, request: web.Request) -> web.Response:
+        """GET /stats — số proxy theo từng giá trị của mỗi chỉ mục"""
+        index = self.proxy_index()
+        stats = {'total': len(index.proxies), 'candidates': len(self.raw_proxies),
+                 'live': len(self.live_proxies), 'queued': len(self.pending)}
+        if GATEWAY_PORT:
+            stats['gateway'] = dict(self.gateway_stats, active=sum(self.upstream_active.values()),
+                                    ejected_now=sum(1 for until in self.ejected.values() if until > time.time()))
+        for name, values in index.by.items():
+            stats[name] = {str(value): len(positions) for value, positions in values.items()}
+        return self._api_response(request, dump_json(stats), 'application/json')
+
+    async def start_api(self, host: str, port: int) -> web.AppRunner:
+        app = web.Application()
+        app.router.add_get('/proxies', self.api_proxies)
+        app.router.add_get('/stats', self.api_stats)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logger.info(f"🔎 API truy vấn: http://{host}:{port}/proxies  ·  /stats")
+        return runner
 
     # ----------------------------------------------------------------
-    # GEOLOCATION
+    # GATEWAY — forward proxy HTTP CONNECT + SOCKS5, chuyển tiếp qua proxy live
     # ----------------------------------------------------------------
-    def enrich_geolocation_local(self):
-        if not os.path.exists(DB_COUNTRY) or not os.path.exists(DB_ASN):
-            logger.warning("Không thấy file DB GeoIP. Bỏ qua định vị.")
-            return
+    def _upstream_usable(self, ikey: int, exclude: Set[int], now: float) -> bool:
+        return (ikey not in exclude and ikey in self.live_proxies and self.ejected.get(ikey, 0) <= now
+                and self.upstream_active.get(ikey, 0) < GATEWAY_MAX_PER_UPSTREAM)
+
+    def pick_upstream(self, exclude: Set[int]) -> Optional[int]:
+        """Chọn proxy đã xác nhận, xác suất tỉ lệ với score (proxy nhanh được chọn nhiều hơn)"""
+        now = time.time()
+        if now - self.gateway_built_at >= GATEWAY_POOL_TTL:
+            self.gateway_keys, self.gateway_weights, total = [], [], 0.0
+            for ikey, proxy in self.live_proxies.items():
+                if self.streaks.get(ikey, 0) >= 2:
+                    self.score_proxy(proxy)
+                    total += proxy['score']
+                    self.gateway_keys.append(ikey)
+                    self.gateway_weights.append(total)
+            self.gateway_built_at = now
+        keys, weights = self.gateway_keys, self.gateway_weights
+        if not keys:
+            return None
+        for _ in range(GATEWAY_PICK_TRIES):
+            i = bisect.bisect_right(weights, random.random() * weights[-1])
+            ikey = keys[min(i, len(keys) - 1)]
+            if self._upstream_usable(ikey, exclude, now):
+                return ikey
+        # Phần lớn pool đang bận hoặc bị loại: quét toàn bộ
+        usable = [ikey for ikey in keys if self._upstream_usable(ikey, exclude, now)]
+        return random.choice(usable) if usable else None
+
+    def eject_upstream(self, ikey: int, now: float):
+        """Loại proxy khỏi gateway ngay và đưa lên đầu lịch recheck; recheck thành công sẽ đưa nó trở lại"""
+        self.ejected[ikey] = now + GATEWAY_EJECT_SECONDS
+        self.gateway_stats['ejected'] += 1
+        if self.recheck_heap is not None and ikey in self.recheck_due:
+            self.recheck_due[ikey] = now
+            heapq.heappush(self.recheck_heap, (now, ikey))
+
+    @staticmethod
+    async def _upstream_connect(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, target: TestTarget,
+                                proto: str, username: Optional[str], password: Optional[str]) -> Optional[str]:
+        """Handshake tunnel của gateway: đọc phản hồi đúng độ dài theo giao thức (khác với lượt kiểm tra chỉ
+        đọc 1 lần), để byte đích gửi ngay sau phản hồi còn nằm trong reader và được chuyển tiếp cho client.
+        None = tunnel đã mở, ngược lại là lý do lỗi."""
+        async def read(n: int) -> bytes:
+            return await asyncio.wait_for(reader.readexactly(n), timeout=CHECK_TIMEOUT)
+
+        if proto == 'socks4':
+            writer.write(target.socks4_connect)
+            return None if (await read(8))[1] == 0x5A else 'bad_reply'
+        if proto == 'socks5':
+            writer.write(b'\x05\x02\x00\x02' if username and password else b'\x05\x01\x00')
+            version, method = await read(2)
+            if version != 0x05:
+                return 'bad_reply'
+            if method == 0x02 and username and password:
+                writer.write(b'\x01' + bytes([len(username)]) + username.encode()
+                             + bytes([len(password)]) + password.encode())
+                if (await read(2))[1] != 0x00:
+                    return 'auth_rejected'
+            elif method != 0x00:
+                return 'auth_rejected'
+            writer.write(target.socks5_connect)
+            _, rep, _, atyp = await read(4)
+            if atyp == 0x01:
+                await read(4 + 2)
+            elif atyp == 0x04:
+                await read(16 + 2)
+            elif atyp == 0x03:
+                await read((await read(1))[0] + 2)
+            else:
+                return 'bad_reply'
+            return None if rep == 0x00 else 'bad_reply'
+        writer.write(target.http_request(ProxyFetcher._build_auth_header(username, password)))
         try:
-            reader_country = geoip2.database.Reader(DB_COUNTRY)
-            reader_asn = geoip2.database.Reader(DB_ASN)
-            for key, proxy in self.live_proxies.items():
-                ip = proxy['ip']
-                try:
-                    c_res = reader_country.country(ip)
-                    proxy['country'] = c_res.country.name or 'Unknown'
-                    proxy['countryCode'] = c_res.country.iso_code or '??'
-                except Exception:
-                    pass
-                try:
-                    a_res = reader_asn.asn(ip)
-                    isp = a_res.autonomous_system_organization or 'Unknown'
-                    proxy['isp'] = isp
-                    name = isp.lower()
-                    hosting_kw = ['vps', 'hosting', 'server', 'cloud', 'datacenter', 'digitalocean', 'amazon', 'google', 'ovh', 'hetzner']
-                    cell_kw = ['mobile', 'wireless', 'cellular', 't-mobile', 'vodafone']
-                    res_kw = ['telecom', 'viettel', 'fpt', 'vnpt', 'comcast', 'broadband', 'dsl', 'cable']
-                    if any(kw in name for kw in hosting_kw):
-                        proxy['user_type'] = 'hosting'
-                    elif any(kw in name for kw in cell_kw):
-                        proxy['user_type'] = 'cellular'
-                    elif any(kw in name for kw in res_kw):
-                        proxy['user_type'] = 'residential'
-                    else:
-                        proxy['user_type'] = 'business'
-                except Exception:
-                    pass
-            reader_country.close()
-            reader_asn.close()
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=CHECK_TIMEOUT)
+        except asyncio.LimitOverrunError:
+            return 'bad_reply'
+        return ProxyFetcher._http_failure(head.split(b"\r\n", 1)[0])
+
+    async def _upstream_handshake(self, proxy: Dict[str, Any], target: TestTarget) -> Tuple[
+            Optional[Tuple[asyncio.StreamReader, asyncio.StreamWriter]], Optional[str]]:
+        """Mở tunnel tới đích qua 1 proxy. Trả về ((reader, writer), None) hoặc (None, lý do lỗi)"""
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(proxy['ip'], int(proxy['port'])), timeout=CONNECT_TIMEOUT)
+        except Exception as e:
+            return None, failure_reason(e, connect=True)
+        try:
+            failure = await self._upstream_connect(reader, writer, target, proxy['type'],
+                                                   proxy.get('username'), proxy.get('password'))
         except Exception as e:
-            logger.error(f"Lỗi định vị dữ liệu IP: {e}")
+            failure = failure_reason(e)
+        if failure:
+            self._close_writer(writer)
+            return None, failure
+        return (reader, writer), None
+
+    async def open_upstream(self, host: str, port: int) -> Optional[Tuple[int, asyncio.StreamReader, asyncio.StreamWriter]]:
+        """Thử lần lượt tối đa 1 + GATEWAY_RETRIES proxy khác nhau cho tới khi mở được tunnel"""
+        target = TestTarget(host, port)
+        if PLAIN_IP_RE.match(host):
+            target.set_ip(host, 0)
+        tried: Set[int] = set()
+        for attempt in range(GATEWAY_RETRIES + 1):
+            ikey = self.pick_upstream(tried)
+            if ikey is None:
+                return None
+            tried.add(ikey)
+            if attempt:
+                self.gateway_stats['failovers'] += 1
+            self.upstream_active[ikey] = self.upstream_active.get(ikey, 0) + 1
+            conn, failure = await self._upstream_handshake(self.live_proxies[ikey], target)
+            if conn:
+                return (ikey,) + conn
+            self._release_upstream(ikey)
+            # bad_reply thường là đích từ chối (SOCKS "host unreachable", HTTP 502): thử proxy khác nhưng không loại
+            if failure != 'bad_reply':
+                self.eject_upstream(ikey, time.time())
+        return None
+
+    def _release_upstream(self, ikey: int):
+        active = self.upstream_active.get(ikey, 0) - 1
+        if active > 0:
+            self.upstream_active[ikey] = active
+        else:
+            self.upstream_active.pop(ikey, None)
+
+    @staticmethod
+    async def _socks5_accept(reader: asyncio.StreamReader,
+                             writer: asyncio.StreamWriter) -> Optional[Tuple[str, int, bytes, bytes]]:
+        """Phía server SOCKS5 (byte version đã đọc): không auth, chỉ hỗ trợ CONNECT"""
+        methods = (await reader.readexactly(1))[0]
+        await reader.readexactly(methods)
+        writer.write(b'\x05\x00')
+        _, cmd, _, atyp = await reader.readexactly(4)
+        if atyp == 0x01:
+            host = socket.inet_ntoa(await reader.readexactly(4))
+        elif atyp == 0x03:
+            host = (await reader.readexactly((await reader.readexactly(1))[0])).decode()
+        elif atyp == 0x04:
+            host = socket.inet_ntop(socket.AF_INET6, await reader.readexactly(16))
+        else:
+            writer.write(b'\x05\x08\x00\x01' + bytes(6))
+            return None
+        port = int.from_bytes(await reader.readexactly(2), 'big')
+        if cmd != 0x01:
+            writer.write(b'\x05\x07\x00\x01' + bytes(6))
+            return None
+        return host, port, b'\x05\x00\x00\x01' + bytes(6), b'\x05\x01\x00\x01' + bytes(6)
+
+    @staticmethod
+    async def _http_accept(first: bytes, reader: asyncio.StreamReader,
+                           writer: asyncio.StreamWriter) -> Optional[Tuple[str, int, bytes, bytes]]:
+        """Phía server HTTP: chỉ nhận CONNECT host:port"""
+        head = first + await reader.readuntil(b"\r\n\r\n")
+        parts = head.split(b"\r\n", 1)[0].decode('latin-1').split()
+        if len(parts) != 3 or parts[0].upper() != 'CONNECT':
+            writer.write(b"HTTP/1.1 501 Not Implemented\r\nConnection: close\r\n\r\n")
+            return None
+        host, _, port = parts[1].rpartition(':')
+        if not host or not port.isdigit():
+            writer.write(b"HTTP/1.1 400 Bad Request\r\nConnection: close\r\n\r\n")
+            return None
+        return (host.strip('[]'), int(port), b"HTTP/1.1 200 Connection established\r\n\r\n",
+                b"HTTP/1.1 502 Bad Gateway\r\nConnection: close\r\n\r\n")
+
+    @staticmethod
+    async def _pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+            if writer.can_write_eof():
+                writer.write_eof()
+        except Exception:
+            pass
+
+    async def gateway_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.gateway_stats['connections'] += 1
+        task = asyncio.current_task()
+        self.gateway_tasks.add(task)
+        upstream = None
+        try:
+            async def _accept():
+                first = await reader.readexactly(1)
+                if first == b'\x05':
+                    return await self._socks5_accept(reader, writer)
+                return await self._http_accept(first, reader, writer)
+
+            request = await asyncio.wait_for(_accept(), timeout=GATEWAY_CLIENT_TIMEOUT)
+            if request is None:
+                await writer.drain()
+                return
+            host, port, ok_reply, fail_reply = request
+            upstream = await self.open_upstream(host, port)
+            if upstream is None:
+                self.gateway_stats['failed'] += 1
+                writer.write(fail_reply)
+                await writer.drain()
+                return
+            ikey, up_reader, up_writer = upstream
+            self.gateway_stats['tunnels'] += 1
+            writer.write(ok_reply)
+            # Chiều nào đóng trước thì half-close chiều kia, chờ tối đa GATEWAY_IDLE_TIMEOUT để kết thúc nốt
+            pipes = [asyncio.ensure_future(self._pipe(reader, up_writer)),
+                     asyncio.ensure_future(self._pipe(up_reader, writer))]
+            try:
+                done, pending = await asyncio.wait(pipes, return_when=asyncio.FIRST_COMPLETED)
+                if pending:
+                    await asyncio.wait(pending, timeout=GATEWAY_IDLE_TIMEOUT)
+            finally:
+                for pipe in pipes:
+                    pipe.cancel()
+        except asyncio.CancelledError:
+            # stop_gateway huỷ handler khi dừng daemon: kết thúc bình thường để asyncio không log lỗi
+            pass
+        except Exception:
+            pass
+        finally:
+            self.gateway_tasks.discard(task)
+            if upstream:
+                self._release_upstream(upstream[0])
+                self._close_writer(upstream[2])
+            self._close_writer(writer)
+
+    async def start_gateway(self, host: str, port: int) -> asyncio.AbstractServer:
+        server = await asyncio.start_server(self.gateway_client, host, port)
+        logger.info(f"🔀 Gateway: {host}:{port} (HTTP CONNECT + SOCKS5)")
+        return server
+
+    async def stop_gateway(self, server: asyncio.AbstractServer):
+        """Ngừng nhận kết nối mới, đóng các tunnel đang mở và chờ handler kết thúc"""
+        server.close()
+        handlers = list(self.gateway_tasks)
+        for task in handlers:
+            task.cancel()
+        if handlers:
+            await asyncio.wait(handlers, timeout=5)
+        await server.wait_closed()
+
+    # ----------------------------------------------------------------
+    # GEOLOCATION
+    # ----------------------------------------------------------------
+    def start_enrichment(self, proxies: Optional[List[Dict[str, Any]]] = None) -> Optional[asyncio.Future]:
+        """Định vị proxy (mặc định: mọi proxy live) trong thread pool, chạy song song với lượt xác nhận"""
+        enricher = GeoEnricher()
+        if not enricher.open():
+            return None
+        logger.info("🌍 Đang phân tích nhà mạng và quốc gia...")
+
+        def _enrich(proxies: List[Dict[str, Any]]):
+            started = time.perf_counter()
+            try:
+                enricher.enrich(proxies)
+            except Exception as e:
+                logger.error(f"Lỗi định vị dữ liệu IP: {e}")
+            finally:
+                enricher.close()
+                self.metrics.add_time('enrich', time.perf_counter() - started)
+
+        if proxies is None:
+            proxies = list(self.live_proxies.values())
+        return asyncio.get_running_loop().run_in_executor(None, _enrich, proxies)
 
     # ----------------------------------------------------------------
     # MAIN RUN
     # ----------------------------------------------------------------
+    @staticmethod
+    async def wait_until(aws: List[Any], deadline: Optional[float]) -> int:
+        """Chờ các coroutine/task tới deadline (None = chờ hết), huỷ phần chưa xong và trả về số bị huỷ"""
+        tasks = [asyncio.ensure_future(aw) for aw in aws]
+        if deadline is None or not tasks:
+            await asyncio.gather(*tasks)
+            return 0
+        done, pending = await asyncio.wait(tasks, timeout=max(0.0, deadline - time.time()))
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        for task in done:
+            task.result()
+        return len(pending)
+
     async def run(self):
         self.start_time = time.time()
-        self.semaphore = asyncio.Semaphore(MAX_CONCURRENT)
         self.sources = self.load_sources()
+        self.health.load()
+        self.source_stats.load()
+        self.prior.build(self.health, self.start_time, self.source_stats)
+        self.source_cache.load()
+        verify_deadline = confirm_deadline = None
+        if RUN_BUDGET:
+            self.deadline = self.start_time + RUN_BUDGET
+            verify_deadline = self.start_time + RUN_BUDGET * BUDGET_VERIFY_SHARE
+            confirm_deadline = self.start_time + RUN_BUDGET * BUDGET_CONFIRM_SHARE
+            logger.info(f"⏱️ Ngân sách thời gian: {RUN_BUDGET:.0f}s")
+        await self.targets.resolve()
+        refresher = asyncio.ensure_future(self.targets.refresher())
+        adapting = asyncio.ensure_future(self.controller.run())
+        monitoring = asyncio.ensure_future(self.metrics.monitor())
 
         connector = aiohttp.TCPConnector(
             limit=MAX_CONCURRENT,
@@ -414,58 +2867,164 @@ class ProxyFetcher:
         )
 
         async with aiohttp.ClientSession(connector=connector) as session:
-            # ===== PHASE 1: Fetch sources =====
-            logger.info(f"🔍 Đang cào {len(self.sources)} nguồn proxy...")
-
-            fetch_tasks = [self.fetch_url(session, url) for url in self.sources]
-            results = await asyncio.gather(*fetch_tasks)
-
-            for url, content in results:
-                if content:
-                    found = self.parse_proxy_list(content, url)
-                    if found:
-                        self.working_sources.append(url)
-
-            if self.working_sources:
+            # ===== PHASE 1 + 2: Fetch → parse → verify (streaming) =====
+            # Proxy mới được kiểm tra ngay khi nguồn của nó tải xong; proxy đang backoff bị bỏ qua,
+            # proxy live gần đây được ưu tiên trong hàng đợi.
+            # MAX_CONCURRENT worker cố định: bộ nhớ và chi phí lập lịch phụ thuộc vào concurrency,
+            # không phụ thuộc vào số lượng proxy thô. Số check thực sự chạy do AIMD controller quyết định.
+            # Chế độ nhiều process: cào xong toàn bộ rồi mới chia shard.
+            logger.info(f"🔍 Đang cào {len(self.sources)} nguồn proxy (kiểm tra song song)...")
+            self.check_queue = asyncio.PriorityQueue()
+            verifying = None
+            verify_started = time.perf_counter()
+            if self.processes == 1:
+                verifying = asyncio.ensure_future(self.run_verify_workers(MAX_CONCURRENT))
+
+            # Nguồn hiệu quả thấp (xem SourceStats) không tải lại mỗi lần: dùng danh sách đã cache
+            fetching = []
+            for url in self.sources:
+                cached = self.source_cache.entries.get(url)
+                if cached and self.source_stats.skip_fetch(url):
+                    self.reuse_source(url, cached)
+                else:
+                    fetching.append(url)
+            if len(fetching) < len(self.sources):
+                logger.info(f"📚 Tải thưa: dùng lại cache của {len(self.sources) - len(fetching)} nguồn hiệu quả thấp")
+            with self.metrics.timed('fetch'):
+                cut_sources = await self.wait_until(
+                    [self.fetch_and_parse(session, url) for url in fetching], verify_deadline)
+            self.sources_done.set()
+            self.source_cache.save(self.sources)
+
+            if cut_sources:
+                # Nguồn bị cắt ngang không phải nguồn chết: giữ nguyên sources.txt
+                logger.warning(f"⏱️ Hết ngân sách khi còn {cut_sources} nguồn đang tải")
+            elif self.working_sources:
                 self.clean_dead_sources()
 
             if not self.raw_proxies:
+                if verifying:
+                    await verifying
+                refresher.cancel()
+                adapting.cancel()
+                monitoring.cancel()
                 logger.warning("Không tìm thấy proxy thô nào!")
+                self.write_report(0)
                 return
 
-            # ===== PHASE 2: Verify =====
-            self.total_checks = sum(len(p['protocols']) for p in self.raw_proxies.values())
-            logger.info(f"🔎 Tìm thấy {len(self.raw_proxies)} proxy thô ({self.total_checks} checks). Bắt đầu kiểm tra...")
-
-            verify_coros = []
-            for proxy in self.raw_proxies.values():
-                for proto in proxy['protocols']:
-                    verify_coros.append(self.verify_task(proxy, proto))
-
-            await asyncio.gather(*verify_coros)
+            logger.info(
+                f"🔎 Cào xong sau {time.time() - self.start_time:.1f}s: {len(self.raw_proxies)} proxy thô "
+                f"({self.unchanged_sources} nguồn không đổi, {self.total_checks} checks, "
+                f"bỏ qua {self.skipped_checks} do backoff/nguồn không đổi). Đang chờ kiểm tra..."
+            )
+            if verifying:
+                await self.wait_until([verifying], verify_deadline)
+            else:
+                verify_started = time.perf_counter()
+                await self.verify_sharded(verify_deadline)
+            self.metrics.add_time('verify', time.perf_counter() - verify_started)
+            if self.deadline and self.checked_count < self.total_checks:
+                logger.warning(
+                    f"⏱️ Hết ngân sách kiểm tra: đã chạy {self.checked_count}/{self.total_checks} checks "
+                    f"(ưu tiên proxy có lịch sử/prior tốt nhất)"
+                )
+            first_pass_live = len(self.live_proxies)
 
             elapsed = time.time() - self.start_time
             logger.info(f"✅ Hoàn tất kiểm tra lần 1 trong {elapsed:.1f}s — {len(self.live_proxies)} proxy live")
 
-            # ===== PHASE 2.5: Confirmation check =====
+            # ===== PHASE 2.5 + 3: Confirmation check, enrich trong thread pool cùng lúc =====
+            enriching = self.start_enrichment() if self.live_proxies else None
             if self.live_proxies:
                 pre_confirm = len(self.live_proxies)
                 logger.info(f"🔍 Đang xác nhận lại {pre_confirm} proxy live...")
                 confirm_coros = [self.confirm_task(p) for p in list(self.live_proxies.values())]
-                await asyncio.gather(*confirm_coros)
+                with self.metrics.timed('confirm'):
+                    cut_confirms = await self.wait_until(confirm_coros, confirm_deadline)
+                if cut_confirms:
+                    # Proxy chưa kịp xác nhận vẫn đã live ở lượt 1 → vẫn được export
+                    logger.warning(f"⏱️ Hết ngân sách xác nhận: {cut_confirms} proxy giữ kết quả lượt 1")
                 removed = pre_confirm - len(self.live_proxies)
                 logger.info(f"✅ Xác nhận xong: {pre_confirm} → {len(self.live_proxies)} proxy sống sót (loại bỏ {removed} proxy chập chờn)")
 
-            # ===== PHASE 3: Enrich =====
-            logger.info("🌍 Đang phân tích nhà mạng và quốc gia...")
-            self.enrich_geolocation_local()
+            refresher.cancel()
+            adapting.cancel()
+            if enriching:
+                await enriching
 
         # ===== PHASE 4: Export =====
-        self.export_all_formats()
+        with self.metrics.timed('export'):
+            self.export_all_formats()
+        self.health.save()
+        self.account_sources()
+        monitoring.cancel()
+        self.write_report(first_pass_live)
+
+    def write_report(self, first_pass_live: int):
+        self.metrics.write({
+            'duration_s': round(time.time() - self.start_time, 2),
+            'sources': {
+                'total': len(self.sources),
+                'working': len(self.working_sources),
+                'unchanged': self.unchanged_sources,
+                'demoted': sum(1 for url in self.sources if self.source_stats.demoted(url)),
+                'throttled': sum(1 for url in self.sources if self.source_stats.throttled(url)),
+                'dying': sum(1 for url in self.sources if self.source_stats.dying(url)),
+            },
+            'candidates': len(self.raw_proxies),
+            'checks': {'queued': self.total_checks, 'done': self.checked_count, 'skipped': self.skipped_checks},
+            'live': first_pass_live,
+            'confirmed': len(self.live_proxies),
+            'concurrency_limit': self.controller.limit,
+            'budget_s': RUN_BUDGET,
+        })
 
     # ----------------------------------------------------------------
     # DEAD SOURCE MANAGEMENT
     # ----------------------------------------------------------------
+    def account_sources(self, proxies: Optional[List[Dict[str, Any]]] = None, since: Optional[float] = None):
+        """Cập nhật thống kê cho mọi nguồn đã tải/dùng lại trong lần chạy: số ứng viên,
+        số ứng viên không nguồn nào khác có, số ứng viên đã được kiểm tra từ `since` (mặc định: đầu lần chạy)
+        và số proxy live (đã xác nhận) mà nguồn có liệt kê.
+
+        Lần chạy bị cắt (--budget, daemon còn tồn đọng): nguồn chưa có ứng viên nào được kiểm tra
+        không được ghi nhận và không nguồn nào bị tính là "khô", để nguồn prior thấp không bị
+        giáng cấp / đánh [DIE] chỉ vì xếp cuối hàng đợi."""
+        if proxies is None:
+            proxies = list(self.live_proxies.values())
+        if since is None:
+            since = self.start_time
+        cut = self.checked_count < self.total_checks
+        listed: Dict[str, List[str]] = {}
+        counts: Dict[str, int] = {}
+        for url in set(self.source_stats.fetched) | self.source_stats.reused:
+            entry = self.source_cache.entries.get(url)
+            if not entry:
+                continue
+            groups = list(entry['parsed']['groups'].values())
+            keys = groups[0] if len(groups) == 1 else list(set().union(*groups))
+            listed[url] = keys
+            for key in keys:
+                counts[key] = counts.get(key, 0) + 1
+        live = {f"{p['ip']}:{p['port']}" for p in proxies}
+        now = time.time()
+        checked_keys: Dict[str, bool] = {}
+        for url, keys in listed.items():
+            checked = 0
+            for key in keys:
+                was_checked = checked_keys.get(key)
+                if was_checked is None:
+                    ip, _, port = key.rpartition(':')
+                    was_checked = checked_keys[key] = self.health.checked_since(pack_key(ip, port), since)
+                checked += was_checked
+            if cut and not checked:
+                continue
+            self.source_stats.update(url, len(keys), sum(1 for key in keys if counts[key] == 1), checked,
+                                     sum(1 for key in keys if key in live), now, complete=not cut)
+        self.source_stats.fetched.clear()
+        self.source_stats.reused.clear()
+        self.source_stats.save(self.sources)
+
     def clean_dead_sources(self):
         with open(SOURCES_FILE, 'w', encoding='utf-8') as f:
             for line in self.all_source_lines:
@@ -479,7 +3038,7 @@ class ProxyFetcher:
                 elif line_strip.startswith('#'):
                     f.write(line)
                     continue
-                if current_url in self.working_sources:
+                if current_url in self.working_sources and not self.source_stats.dying(current_url):
                     f.write(f"{current_url}\n")
                 else:
                     f.write(f"# [DIE] {current_url}\n")
@@ -488,42 +3047,46 @@ class ProxyFetcher:
     # ----------------------------------------------------------------
     # EXPORT
     # ----------------------------------------------------------------
-    def export_all_formats(self):
-        live_list = list(self.live_proxies.values())
-
-        with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
-            f.write(f"# Auto Proxy List\n# Build Time: {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S UTC')}\n")
-            for p in live_list:
-                auth = f"{p['username']}:{p['password']}@" if p.get('username') else ""
-                uri = f"{p['type']}://{auth}{p['ip']}:{p['port']}"
-                f.write(f"{uri:<45} | {p['country']} ({p['countryCode']}) | User: {p['user_type']:<12} | ISP: {p['isp']}\n")
-
-        os.makedirs('api/types', exist_ok=True)
-        os.makedirs('api/countries', exist_ok=True)
-
-        with open('api/all.json', 'w', encoding='utf-8') as f:
-            json.dump({'updated_at': datetime.utcnow().isoformat(), 'total': len(live_list), 'data': live_list}, f, ensure_ascii=False, indent=2)
-
-        types_dict = {}
-        countries_dict = {}
+    def export_all_formats(self, proxies: Optional[List[Dict[str, Any]]] = None):
+        if proxies is None:
+            proxies = list(self.live_proxies.values())
+        # Sắp xếp theo bậc latency (nhanh đứng đầu), cùng bậc thì theo ip:port — dao động đo đạc nhỏ
+        # giữa các lần chạy không làm đổi thứ tự, nên file không đổi thì không bị ghi lại
+        for p in proxies:
+            self.score_proxy(p)
+        live_list = [self.export_record(p) for p in proxies]
+        live_list.sort(key=lambda p: (p['latency_ms'], pack_key(p['ip'], p['port'])))
+
+        writer = ExportWriter()
+        build_time = datetime.utcnow()
+        updated_at = build_time.isoformat()
+
+        lines = []
         for p in live_list:
-            t_type = p['user_type']
-            c_code = p['countryCode']
-            if t_type not in types_dict:
-                types_dict[t_type] = []
-            types_dict[t_type].append(p)
-            if c_code != '??':
-                if c_code not in countries_dict:
-                    countries_dict[c_code] = []
-                countries_dict[c_code].append(p)
+            auth = f"{p['username']}:{p['password']}@" if p.get('username') else ""
+            uri = f"{p['type']}://{auth}{p['ip']}:{p['port']}"
+            lines.append(f"{uri:<45} | {p['country']} ({p['countryCode']}) | User: {p['user_type']:<12} | ISP: {p['isp']} | ≤{p['latency_ms']} ms\n")
+        header = f"# Auto Proxy List\n# Build Time: {build_time.strftime('%Y-%m-%d %H:%M:%S UTC')}\n".encode('utf-8')
+        writer.write(OUTPUT_FILE, ''.join(lines).encode('utf-8'), lambda body: header + body)
+
+        # Mỗi proxy serialize đúng 1 lần, các file JSON chỉ ghép lại các bản đã encode
+        encoded = [dump_json(p) for p in live_list]
+        writer.write_json('api/all.json', encoded, updated_at)
+        writer.write_json('api/fast.json', [e for p, e in zip(live_list, encoded) if p['latency_ms'] <= FAST_LATENCY_MS], updated_at)
+
+        types_dict: Dict[str, List[bytes]] = {}
+        countries_dict: Dict[str, List[bytes]] = {}
+        for p, e in zip(live_list, encoded):
+            types_dict.setdefault(p['user_type'], []).append(e)
+            if p['countryCode'] != '??':
+                countries_dict.setdefault(p['countryCode'], []).append(e)
 
         for t, data in types_dict.items():
-            with open(f'api/types/{t}.json', 'w', encoding='utf-8') as f:
-                json.dump({'updated_at': datetime.utcnow().isoformat(), 'total': len(data), 'data': data}, f, ensure_ascii=False, indent=2)
-
+            writer.write_json(f'api/types/{t}.json', data, updated_at)
         for c, data in countries_dict.items():
-            with open(f'api/countries/{c}.json', 'w', encoding='utf-8') as f:
-                json.dump({'updated_at': datetime.utcnow().isoformat(), 'total': len(data), 'data': data}, f, ensure_ascii=False, indent=2)
+            writer.write_json(f'api/countries/{c}.json', data, updated_at)
+        writer.prune('api/types')
+        writer.prune('api/countries')
 
         sub_uris = []
         country_counters = {}
@@ -537,16 +3100,115 @@ class ProxyFetcher:
             sub_uris.append(uri_with_remark)
 
         sub_content = '\n'.join(sub_uris)
-        b64_sub = base64.b64encode(sub_content.encode('utf-8')).decode('utf-8')
-
-        with open('sub.txt', 'w', encoding='utf-8') as f:
-            f.write(b64_sub)
+        writer.write('sub.txt', base64.b64encode(sub_content.encode('utf-8')))
+        self.export_web(writer, live_list, build_time)
+        writer.save()
 
         elapsed = time.time() - self.start_time
+        logger.info(
+            f"📦 Export: ghi {writer.written} file ({writer.bytes_written / 1024:.0f} KB), "
+            f"giữ nguyên {writer.unchanged} file không đổi, xoá {writer.removed} file cũ"
+        )
         logger.info(f"🚀 Thành công! Xuất {len(live_list)} proxy. Tổng: {elapsed:.1f}s")
 
+    @staticmethod
+    def export_record(proxy: Dict[str, Any]) -> Dict[str, Any]:
+        """Bản ghi cho file export: bỏ các mẫu đo / thời điểm kiểm tra; latency chỉ giữ bậc LATENCY_TIERS_MS,
+        score tính từ bậc đó và tốc độ tải (nếu có đo) chỉ giữ bậc SPEED_TIERS_KBPS"""
+        record = {field: proxy.get(field) for field in EXPORT_FIELDS}
+        tier = bisect.bisect_left(LATENCY_TIERS_MS, proxy['latency_ms'])
+        latency = record['latency_ms'] = LATENCY_TIERS_MS[min(tier, len(LATENCY_TIERS_MS) - 1)]
+        record['score'] = round(100 * LATENCY_REF_MS / (LATENCY_REF_MS + latency), 1)
+        if proxy.get('speed_kbps') is not None:
+            record['speed_kbps'] = SPEED_TIERS_KBPS[max(0, bisect.bisect_right(SPEED_TIERS_KBPS, proxy['speed_kbps']) - 1)]
+        return record
+
+    @staticmethod
+    def export_web(writer: ExportWriter, live_list: List[Dict[str, Any]], build_time: datetime):
+        """Dữ liệu cho index.html: manifest (số lượng theo quốc gia / loại / protocol, số shard) và các
+        shard dạng mảng hàng gọn theo thứ tự của live_list — 'all-N.json' và '<user_type>-N.json'.
+        Trang web chỉ tải manifest + shard đầu, các shard sau được tải khi lọc / chuyển trang."""
+        groups: Dict[str, List[bytes]] = {'all': []}
+        counts: Dict[str, Dict[str, int]] = {'country': {}, 'user_type': {}, 'type': {}}
+        for p in live_list:
+            auth = f"{p['username']}:{p['password']}@" if p.get('username') else ""
+            row = dump_json([f"{p['type']}://{auth}{p['ip']}:{p['port']}", p['country'], p['countryCode'],
+                             p['user_type'], p['isp'], p['latency_ms']])
+            groups['all'].append(row)
+            groups.setdefault(p['user_type'], []).append(row)
+            for name, value in (('country', p['countryCode']), ('user_type', p['user_type']), ('type', p['type'])):
+                counts[name][value] = counts[name].get(value, 0) + 1
+
+        # version đổi khi bất kỳ shard nào đổi: trang web thêm ?v=version để không dùng shard cũ trong cache
+        version = hashlib.blake2b(digest_size=6)
+        shards = {}
+        for group, rows in groups.items():
+            shards[group] = (len(rows) + WEB_SHARD_SIZE - 1) // WEB_SHARD_SIZE
+            for n in range(shards[group]):
+                body = b'[' + b','.join(rows[n * WEB_SHARD_SIZE:(n + 1) * WEB_SHARD_SIZE]) + b']'
+                version.update(body)
+                writer.write(f'{WEB_DIR}/{group}-{n}.json', body)
+
+        manifest = dump_json({
+            'version': version.hexdigest(),
+            'total': len(live_list),
+            'shard_size': WEB_SHARD_SIZE,
+            'columns': ['proxy', 'country', 'countryCode', 'user_type', 'isp', 'latency_ms'],
+            'shards': shards,
+            'counts': {name: dict(sorted(c.items(), key=lambda kv: -kv[1])) for name, c in counts.items()},
+        })
+        header = b'{"build_time":' + dump_json(build_time.strftime('%Y-%m-%d %H:%M:%S UTC')) + b','
+        writer.write(f'{WEB_DIR}/index.json', manifest, lambda body: header + body[1:])
+        writer.prune(WEB_DIR)
+
+
+def _verify_shard(items: List[Tuple[float, int, int, int, Optional[Tuple[str, str]]]], concurrency: int,
+                  deadline: Optional[float] = None, engine: str = CHECK_ENGINE):
+    return asyncio.run(ProxyFetcher().verify_shard(items, concurrency, deadline, engine))
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Auto Proxy Fetcher")
+    parser.add_argument('--processes', type=int, default=VERIFY_PROCESSES,
+                        help="số process kiểm tra song song (0 = số CPU)")
+    parser.add_argument('--prometheus', metavar='PATH', default=PROMETHEUS_FILE,
+                        help="ghi thêm số liệu lần chạy dạng Prometheus text vào PATH")
+    parser.add_argument('--daemon', action='store_true',
+                        help="chạy liên tục: tải lại nguồn, kiểm tra lại proxy live theo lịch, xuất snapshot định kỳ")
+    parser.add_argument('--api', metavar='[HOST:]PORT',
+                        help="(với --daemon) mở HTTP API truy vấn pool live: /proxies, /stats")
+    parser.add_argument('--gateway', metavar='[HOST:]PORT',
+                        help="(với --daemon) mở forward proxy HTTP CONNECT + SOCKS5 xoay vòng qua pool live")
+    parser.add_argument('--budget', type=float, metavar='SECONDS', default=RUN_BUDGET,
+                        help="giới hạn thời gian chạy: proxy triển vọng được kiểm tra trước, hết giờ thì export phần đã có")
+    parser.add_argument('--engine', choices=('streams', 'protocol'), default=CHECK_ENGINE,
+                        help="engine kiểm tra: streams (StreamReader/Writer) hoặc protocol (asyncio.Protocol, ít CPU hơn)")
+    args = parser.parse_args()
+    PROMETHEUS_FILE = args.prometheus
+    RUN_BUDGET = args.budget
+    CHECK_ENGINE = args.engine
+    if CHECK_ENGINE == 'protocol' and not hasattr(asyncio, 'timeout'):
+        logger.warning("Engine 'protocol' cần Python 3.11+, dùng engine 'streams'")
+        CHECK_ENGINE = 'streams'
+    if args.budget and args.daemon:
+        parser.error("--budget không dùng được cùng --daemon")
+    if (args.api or args.gateway) and not args.daemon:
+        parser.error("--api / --gateway chỉ dùng được cùng --daemon")
+    if args.api:
+        host, _, port = args.api.rpartition(':')
+        API_HOST = host or API_HOST
+        API_PORT = int(port)
+    if args.gateway:
+        host, _, port = args.gateway.rpartition(':')
+        GATEWAY_HOST = host or GATEWAY_HOST
+        GATEWAY_PORT = int(port)
+
     if sys.platform == 'win32':
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
-    asyncio.run(ProxyFetcher().run())
+    if args.daemon:
+        try:
+            asyncio.run(ProxyFetcher().run_daemon())
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            pass
+    else:
+        asyncio.run(ProxyFetcher(processes=args.processes or os.cpu_count() or 1).run())